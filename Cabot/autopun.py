@@ -22,14 +22,29 @@ Produce a phonetic pun over some text.
 Usage: autopun [OPTION]... [FILE]
 
 Options:
+  -b         Build a binary phone index from FILE.
   -c         Convert FILE instead of reparsing standard input.
+  -j NUMBER  Use NUMBER processes (default: CPU count).
+  -l         Without -b or -c, write JSON lines, with timings.
+  -r FILE    With -c, write rejected words to FILE (default `rejects').
+  -t SECONDS With -c, reject words taking longer (default 1).
 
 If -c is given, FILE is a list of English words and defaults to
-`/usr/share/dict/words'.  A phone file is produced on standard output.  If -c
-is not given, FILE is a phone file and defaults to `phones' in the database
-directory; using it, each line of standard input creates a phonemically-simiar
-line on standard output.  For example, "Happy Birthday" can be recast as "Hub
-pip Earth tee".
+`/usr/share/dict/words'.  A phone file is produced on standard output, in
+the order of FILE.  Words which cannot be converted within the time limit, or
+produce no phonemes, are rejected instead.  Progress, then histograms of word
+lengths and phone lengths, are reported on standard error.  If -c is not
+given, FILE is a phone file and defaults to `phones.index', or else
+`phones', in the database directory; using it, each line of standard input
+creates a phonemically-simiar line on standard output.  For example, "Happy
+Birthday" can be recast as "Hub pip Earth tee".  Lines are processed in
+parallel, yet output in order.  With -l, each output line is rather a JSON
+object giving the input `text', the `pun' or null, and `seconds' it took.
+
+If -b is given, FILE is a phone file and defaults to `phones' in the database
+directory.  A binary phone index is produced on standard output, it should be
+saved as `phones.index' in the database directory.  It is mapped in memory
+rather than read, so loading it is immediate and its pages are shared.
 """
 
 # The C sources, "v02i096: autopun - phonetically reparse English phrases",
@@ -46,31 +61,158 @@ pip Earth tee".
 
 # FIXME:
 # - The `I' word is missing from `phones'?
-# - `Modula-2' in `dicts' keeps the converter in a loop.
-# - Histograms/statistics while converting, eradicate long words.
+# - Eradicate long words.
 
 __metaclass__ = type
-import random, sys
+import collections, itertools, os, random, re, signal, struct, sys, time
 import common
 
 class AutoPun(common.Command):
-    "pun SENTENCE (phonetic pun)."
+    "pun [-b|-n COUNT] SENTENCE (phonetic pun, fewest words or COUNT ones)."
     extra_keywords = 'pun'
     burp_weight = 1
     number_arguments = 1
+    maximum_count = 10
+    # Puns are cut short after SECONDS_BUDGET seconds, then only cover the
+    # text translated and matched so far.  When THREADED, puns are rather
+    # produced by a worker thread, and the reply comes later.  Worker jobs
+    # then run one at a time, so only the worker uses the pun caches and
+    # factoids, and a newer request from a target cancels the previous one.
+    seconds_budget = .25
+    threaded = False
+    # When FACTOIDS, database keys may also appear in puns.  Their phones
+    # are computed in the background, SLICE_SECONDS at a time, every
+    # SLICE_INTERVAL seconds.
+    factoids = True
+    slice_seconds = .02
+    slice_interval = .1
+
+    def __init__(self):
+        # REQUESTS holds (TEXT, CONTEXT) pairs waiting for the worker, the
+        # CONTEXT being what `Server.reply' needs.  RUNNING is (TARGET,
+        # BUDGET) for the job in the worker thread, or None.  When
+        # UPDATE_WANTED, the worker should update factoids once idle.
+        self.requests = collections.deque()
+        self.running = None
+        self.update_scheduled = False
+        self.update_wanted = False
 
     def split_arguments(self, line):
         return line,
 
     def handler(self, write, text):
-        text = run.produce_some_pun(text)
-        if text:
-            write(text + '\n')
+        # The database is opened by the main thread, here, as connections
+        # may not be shared between threads.
+        if self.factoids and run.factoids is None:
+            run.use_factoids(self.schedule_update)
+        if self.threaded and common.server is not None:
+            self.request(text)
+            # Stop any further burp, the reply comes later.
+            write('')
+            return
+        if run.factoids is not None and common.server is None:
+            # Without a bot, nothing else would update factoids.
+            run.factoids.update()
+        for pun in self.produce(text, Budget(self.seconds_budget)):
+            write(pun + '\n')
+
+    def produce(self, text, budget):
+        match = re.match(r'-(b|n *([0-9]+)) +', text)
+        if match is None:
+            return run.produce_puns(text, 1, budget)
+        if match.group(2) is None:
+            return filter(None, [run.produce_best_pun(text[match.end():],
+                                                      budget)])
+        count = min(int(match.group(2)), self.maximum_count)
+        return run.produce_puns(text[match.end():], count, budget)
+
+    def request(self, text):
+        server = common.server
+        context = server.writer, server.target, server.encoding
+        for queued in list(self.requests):
+            if queued[1][1] == server.target:
+                self.requests.remove(queued)
+        if self.running is not None and self.running[0] == server.target:
+            self.running[1].cancel()
+        self.requests.append((text, context))
+        self.next_job()
+
+    def cancel(self):
+        # Abandon all puns, as when the bot quits.
+        self.requests.clear()
+        if self.running is not None:
+            self.running[1].cancel()
+
+    def next_job(self):
+        if self.running is not None:
+            return
+        if self.requests:
+            text, context = self.requests.popleft()
+            budget = Budget(self.seconds_budget)
+
+            def reply(puns):
+                self.job_done()
+                if puns and not budget.cancelled:
+                    common.server.reply(*(context + (
+                        ''.join([pun + '\n' for pun in puns]),)))
+
+            self.start_job(context[1], budget, self.produce, (text, budget),
+                           reply)
+        elif self.update_wanted:
+            self.update_wanted = False
+            budget = Budget(self.slice_seconds)
+
+            def updated(done):
+                self.job_done()
+                if not done:
+                    self.schedule_update()
+
+            self.start_job(None, budget, run.factoids.update, (budget,),
+                           updated)
+
+    def start_job(self, target, budget, function, arguments, callback):
+
+        def fail(*exc_info):
+            self.job_done()
+            import traceback
+            traceback.print_exception(*(exc_info + (None, sys.stderr)))
+
+        self.running = target, budget
+        common.server.connection.execute_in_thread(function, arguments,
+                                                   callback, fail)
+
+    def job_done(self):
+        self.running = None
+        self.next_job()
+
+    def schedule_update(self):
+        if not self.update_scheduled and common.server is not None:
+            common.server.connection.execute_delayed(self.slice_interval,
+                                                     self.update)
+            self.update_scheduled = True
+
+    def update(self):
+        self.update_scheduled = False
+        if self.threaded:
+            self.update_wanted = True
+            self.next_job()
+        elif not run.factoids.update(Budget(self.slice_seconds)):
+            self.schedule_update()
 
 class Main:
+    build = False
     convert = False
+    processes = None
+    rejects = 'rejects'
+    time_limit = 1.
+    chunk_size = 500
+    json = False
+    lines_per_chunk = 100
     words = '/usr/share/dict/words'
-    word_phone_pairs = None
+    automaton = None
+    factoids = None
+    pun_cache_size = 1000
+    variants_per_phone = 16
     phone = None
     squash_table = None
 
@@ -107,112 +249,863 @@ class Main:
                 after += phone[0] * (len(phone) - 1)
         import string
         self.squash_table = string.maketrans(before, after)
+        self.pun_cache = common.Cache(self.pun_cache_size)
 
     def main(self, *arguments):
         import getopt
-        options, arguments = getopt.getopt(arguments, 'c')
+        options, arguments = getopt.getopt(arguments, 'bcj:lr:t:')
         for option, value in options:
-            if option == '-c':
+            if option == '-b':
+                self.build = True
+            elif option == '-c':
                 self.convert = True
-        if self.convert:
+            elif option == '-j':
+                self.processes = int(value)
+            elif option == '-l':
+                self.json = True
+            elif option == '-r':
+                self.rejects = value
+            elif option == '-t':
+                self.time_limit = float(value)
+        if self.build:
+            assert len(arguments) <= 1, arguments
+            if arguments:
+                name = arguments[0]
+            else:
+                name = '%s/phones' % common.datadir
+            Automaton(read_phone_words(name)).write(sys.stdout)
+        elif self.convert:
             assert len(arguments) <= 1, arguments
             if arguments:
                 name = arguments[0]
             else:
                 name = '/usr/share/dict/words'
-            for line in file(name):
-                word = line.rstrip()
-                phone = xlate_word(word).translate(self.squash_table)
-                sys.stdout.write('%s ' % word)
-                sys.stdout.flush()
-                sys.stdout.write('%s\n' % phone)
+            self.convert_words(name)
         else:
             assert len(arguments) <= 1, arguments
             if arguments:
                 self.load_phones(arguments[0])
-            line = sys.stdin.readline()
-            while line:
-                pun = self.produce_some_pun(line, pairs)
-                if pun is None:
-                    sys.stdout.write("None found!\n")
+            else:
+                self.load_phones()
+            self.pun_lines(sys.stdin)
+
+    def pun_lines(self, input):
+        # Chunks of lines are punned in parallel, but results come back in
+        # order.  Phones are loaded before forking, so processes share them.
+        if input.isatty():
+            chunks = iter(lambda: [input.readline()], [''])
+        else:
+            chunks = read_chunks(input, self.lines_per_chunk)
+        if self.processes == 1:
+            results = itertools.imap(pun_chunk, chunks)
+        else:
+            import multiprocessing
+            # Reseed each process, lest they all draw the same puns.
+            pool = multiprocessing.Pool(self.processes, random.seed)
+            if input.isatty():
+                # Pun each line as soon as it is typed.
+                window = 1
+            else:
+                window = self.chunks_in_flight()
+            results = bounded_imap(pool, pun_chunk, chunks, window)
+        if self.json:
+            import json
+        count = 0
+        start = time.time()
+        for result in results:
+            lines = []
+            for text, pun, seconds in result:
+                if self.json:
+                    lines.append(json.dumps(
+                        {'text': text.decode('UTF-8', 'replace'),
+                         'pun': pun and pun.decode('UTF-8', 'replace'),
+                         'seconds': round(seconds, 6)}) + '\n')
+                elif pun is None:
+                    lines.append("None found!\n")
                 else:
-                    sys.stdout.write(pun + "\n")
-                line = sys.stdin.readline()
+                    lines.append(pun + "\n")
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+            count += len(result)
+        elapsed = max(time.time() - start, 1e-6)
+        sys.stderr.write('%d lines punned in %.1f seconds (%.0f lines/s)\n'
+                         % (count, elapsed, count / elapsed))
+
+    def convert_words(self, name):
+        # Chunks are converted in parallel, but results come back in order.
+        words = [line.rstrip() for line in file(name)]
+        chunks = [(words[counter:counter+self.chunk_size], self.time_limit)
+                  for counter in range(0, len(words), self.chunk_size)]
+        if self.processes == 1:
+            results = itertools.imap(convert_chunk, chunks)
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool(self.processes)
+            results = bounded_imap(pool, convert_chunk, chunks,
+                                   self.chunks_in_flight())
+        rejects = file(self.rejects, 'w')
+        word_lengths = {}
+        phone_lengths = {}
+        count = rejected = 0
+        start = reported = time.time()
+        for result in results:
+            lines = []
+            for word, phone, reason in result:
+                if phone is None:
+                    rejects.write('%s %s\n' % (word, reason))
+                    rejected += 1
+                    continue
+                lines.append('%s %s\n' % (word, phone))
+                word_lengths[len(word)] = word_lengths.get(len(word), 0) + 1
+                phone_lengths[len(phone)] = (
+                    phone_lengths.get(len(phone), 0) + 1)
+            sys.stdout.write(''.join(lines))
+            count += len(result)
+            now = time.time()
+            if now - reported >= 1:
+                reported = now
+                sys.stderr.write('\r%d/%d words, %.0f words/s'
+                                 % (count, len(words), count / (now - start)))
+        rejects.close()
+        sys.stdout.flush()
+        elapsed = max(time.time() - start, 1e-6)
+        sys.stderr.write('\r%d words converted, %d rejected,'
+                         ' in %.1f seconds (%.0f words/s)\n'
+                         % (count - rejected, rejected, elapsed,
+                            count / elapsed))
+        write_histogram("Word length", word_lengths)
+        write_histogram("Phone length", phone_lengths)
+
+    def chunks_in_flight(self):
+        # Keep every process busy, but do not read input much further.
+        import multiprocessing
+        return 2 * (self.processes or multiprocessing.cpu_count())
+
+    def produce_some_pun(self, text, budget=None):
+        puns = self.segment(text, budget).sample(1)
+        if puns:
+            return puns[0]
+
+    def produce_puns(self, text, count, budget=None):
+        return self.segment(text, budget).sample(count)
+
+    def produce_best_pun(self, text, budget=None):
+        return self.segment(text, budget).best()
 
-    def produce_some_pun(self, text):
-        text_phone = xlate_line(text).translate(self.squash_table)
-        # Make AT returns a list of (NEXT, WORD) tuples for a given position
-        # in TEXT_PHONE.  Choosing WORD would push position to NEXT.
+    def segment(self, text, budget=None):
+        # If BUDGET gets exhausted, only segment the text phone as far as
+        # it got translated and matched.  Translating may only use half of
+        # the budget, so matching always has some left.
+        if budget is None:
+            text_phone = xlate_line(text)
+        else:
+            text_phone = xlate_line(text, budget.part(.5))
+        text_phone = text_phone.translate(self.squash_table)
+        # Repeated phrases, or phrases sounding the same, only need a new
+        # random draw.  PUN_CACHE maps a text phone to a list [SIZE, AT,
+        # WORDS, VARIANTS, GENERATION, MATCHES].  AT only holds dictionary
+        # words, see `match', and WORDS are all its words.  MATCHES are the
+        # factoid matches, see `match_factoids', as of the factoid
+        # GENERATION.  VARIANTS holds segmentations, indexed by the set of
+        # words to avoid, and the factoid edges.
+        entry = self.pun_cache.get(text_phone)
+        if entry is None:
+            size, at = self.match(text_phone, budget)
+            words = set()
+            for edges in at.itervalues():
+                for next, bucket in edges:
+                    words.update(bucket)
+            entry = [size, at, words, {}, None, ()]
+            if size == len(text_phone):
+                self.pun_cache[text_phone] = entry
+        size, at, words, variants, generation, matches = entry
+        factoid_edges = ()
+        if self.factoids is not None:
+            if generation != self.factoids.generation:
+                matches = self.match_factoids(text_phone, size)
+                entry[4:] = self.factoids.generation, matches
+            # Keys may have changed for known phones, fetch them anew.
+            factoid_edges = tuple([(position, next, self.factoids.words(phone))
+                                   for position, next, phone in matches])
+            for position, next, keys in factoid_edges:
+                words = words.union(keys)
+        avoid_words = frozenset(words.intersection(text.split()))
+        segmentations = variants.get((avoid_words, factoid_edges))
+        if segmentations is None:
+            if factoid_edges:
+                at = merge(at, factoid_edges)
+            if avoid_words:
+                at = avoid(at, avoid_words)
+            if len(variants) >= self.variants_per_phone:
+                variants.clear()
+            segmentations = variants[avoid_words, factoid_edges] = (
+                Segmentations(size, at))
+        return segmentations
+
+    def match(self, text_phone, budget=None):
+        # Return (SIZE, AT).  AT maps a position in TEXT_PHONE to a list of
+        # (NEXT, WORDS) tuples.  Choosing any of WORDS, which all share the
+        # same phone, would push position to NEXT.  SIZE is the length of
+        # TEXT_PHONE, unless BUDGET got exhausted while matching.
         at = {}
-        avoid_words = set(text.split())
-        if self.word_phone_pairs is None:
+        size = len(text_phone)
+        if self.automaton is None:
             self.load_phones()
-        for word, phone in self.word_phone_pairs:
-            position = text_phone.find(phone)
-            if position >= 0 and word not in avoid_words:
-                while position >= 0:
-                    if position not in at:
-                        at[position] = []
-                    at[position].append((position + len(phone), word))
-                    position = text_phone.find(phone, position + 1)
-
-        def transform(start):
-            # Turn AT[START] into a single (WEIGHT, TEXT) tuple and
-            # return True, if some solution exists, otherwise delete it and
-            # return False.  TEXT is a white-joined string of words covering
-            # TEXT_PHONE[START:], randomly chosen over WEIGHT possibilities.
-            solutions = []
-            total = 0
-            for next, word in at[start]:
-                if next == len(text_phone):
-                    total += 1
-                    solutions.append((total, word))
-                    continue
-                if next not in at:
-                    continue
-                if not isinstance(at[next], tuple):
-                    if not transform(next):
-                        continue
-                weight, text = at[next]
-                total += weight
-                solutions.append((total, word + ' ' + text))
-            if solutions:
-                select = random.randrange(0, total)
-                for partial, text in solutions:
-                    if select < partial:
-                        at[start] = total, text
-                        return True
-            del at[start]
-            return False
+        for position, next, phone in self.automaton.matches(text_phone):
+            if budget is not None and not budget.spend():
+                # Matches come by increasing NEXT, so all those ending
+                # before this one have been seen.  Cover the longest prefix
+                # reachable with them.
+                reachable = set([0])
+                for start in sorted(at):
+                    if start in reachable:
+                        for end, words in at[start]:
+                            if end < next:
+                                reachable.add(end)
+                size = max(reachable)
+                for start, edges in at.iteritems():
+                    at[start] = [edge for edge in edges if edge[0] <= size]
+                break
+            if position not in at:
+                at[position] = []
+            at[position].append((next, self.automaton.words(phone)))
+        return size, at
+
+    def match_factoids(self, text_phone, size):
+        # Return (POSITION, NEXT, PHONE) tuples for factoid phones found in
+        # the first SIZE characters of TEXT_PHONE.  Factoid phones are known
+        # beforehand, and matching them is quick, so it is not budgeted.
+        return tuple([match for match in self.factoids.matches(text_phone)
+                      if match[1] <= size])
 
-        if 0 in at and transform(0):
-            return at[0][1]
+    def use_factoids(self, wake=None):
+        # Also pun with database keys, following the database as it changes.
+        # WAKE is called whenever factoids need an update, see Phone_trie.
+        import database
+        self.factoids = Phone_trie()
+        self.factoids.wake = wake
+        database.database.add_word_listener(self.factoids)
 
     def load_phones(self, name=None):
         if name is None:
-            name = '%s/phones' % common.datadir
-        self.word_phone_pairs = [line.split() for line in file(name)]
+            name = '%s/phones.index' % common.datadir
+            if not os.path.exists(name):
+                name = '%s/phones' % common.datadir
+        if file(name, 'rb').read(len(index_magic)) == index_magic:
+            self.automaton = Phone_index(name)
+        else:
+            self.automaton = Automaton(read_phone_words(name))
+
+def read_phone_words(name):
+    # Many words share a squashed phone, so keep one bucket of words per
+    # distinct phone, and only match distinct phones.
+    phone_words = {}
+    for line in file(name):
+        word, phone = line.split()
+        if phone in phone_words:
+            phone_words[phone].append(word)
+        else:
+            phone_words[phone] = [word]
+    for phone, words in phone_words.iteritems():
+        phone_words[phone] = tuple(words)
+    return phone_words
+
+def merge(at, factoid_edges):
+    # Return a copy of AT, see Main.match, also having FACTOID_EDGES, given
+    # as (POSITION, NEXT, WORDS) tuples.
+    result = {}
+    for position, edges in at.iteritems():
+        result[position] = list(edges)
+    for position, next, words in factoid_edges:
+        if position not in result:
+            result[position] = []
+        result[position].append((next, words))
+    return result
+
+def avoid(at, avoid_words):
+    # Return a copy of AT without words from AVOID_WORDS, see Main.match.
+    result = {}
+    for position, edges in at.iteritems():
+        kept = []
+        for next, words in edges:
+            if not avoid_words.isdisjoint(words):
+                words = [word for word in words if word not in avoid_words]
+                if not words:
+                    continue
+            kept.append((next, words))
+        result[position] = kept
+    return result
+
+class Segmentations:
+    # All puns covering a text phone of SIZE characters, given AT as built
+    # by Main.match.  A single right-to-left pass computes COUNTS, where
+    # COUNTS[POSITION] is the number of puns covering the phone from
+    # POSITION, each word of a bucket counting separately; and BEST, where
+    # BEST[POSITION] is (LENGTH, NEXT, WORDS), LENGTH being the fewest words
+    # covering the phone from POSITION, NEXT and WORDS the edge to take.
+    # Puns are numbered from 0 to COUNTS[0] - 1, so drawing distinct
+    # numbers draws distinct puns.
+
+    def __init__(self, size, at):
+        self.size = size
+        self.at = at
+        self.counts = counts = [0] * (size + 1)
+        self.best_edges = best = [None] * (size + 1)
+        if not size:
+            return
+        counts[size] = 1
+        best[size] = 0, None, None
+        for position in range(size - 1, -1, -1):
+            total = 0
+            for next, words in at.get(position, ()):
+                if counts[next]:
+                    total += len(words) * counts[next]
+                    # On ties, prefer longer words first.
+                    length = best[next][0] + 1
+                    if (best[position] is None
+                            or length < best[position][0]
+                            or (length == best[position][0]
+                                and next > best[position][1])):
+                        best[position] = length, next, words
+            counts[position] = total
+
+    def pun(self, number):
+        # Return the pun numbered NUMBER.
+        fragments = []
+        position = 0
+        while position < self.size:
+            for next, words in self.at[position]:
+                count = self.counts[next]
+                if number < len(words) * count:
+                    fragments.append(words[number // count])
+                    number %= count
+                    position = next
+                    break
+                number -= len(words) * count
+        return ' '.join(fragments)
+
+    def sample(self, count):
+        # Return up to COUNT distinct puns, randomly chosen.
+        total = self.counts[0]
+        if total <= count:
+            numbers = range(total)
+            random.shuffle(numbers)
+        else:
+            numbers = []
+            seen = set()
+            while len(numbers) < count:
+                number = random.randrange(0, total)
+                if number not in seen:
+                    seen.add(number)
+                    numbers.append(number)
+        return map(self.pun, numbers)
+
+    def best(self):
+        # Return a pun having the fewest words, or None.
+        if not self.counts[0]:
+            return None
+        fragments = []
+        position = 0
+        while position < self.size:
+            length, next, words = self.best_edges[position]
+            # Words of a bucket sound the same, any will do.
+            fragments.append(random.choice(words))
+            position = next
+        return ' '.join(fragments)
+
+class Automaton:
+    # Aho-Corasick automaton recognising all word phones at once, so a
+    # single pass over a text phone finds every word fitting anywhere in it.
+    # States are numbered, state 0 being the root.  For each state, GOTO
+    # maps a phone character to the next state, FAIL gives the state for
+    # the longest proper suffix also being a prefix of some word phone,
+    # DEPTH is the length of the prefix the state stands for, PHONE is the
+    # phone ending there or None, and OUTPUT is the nearest state along the
+    # failure chain having a phone, or 0 if none.
+
+    def __init__(self, phone_words):
+        self.phone_words = phone_words
+        self.goto = [{}]
+        self.depth = [0]
+        self.phone = [None]
+        for phone in phone_words:
+            if not phone:
+                continue
+            state = 0
+            for character in phone:
+                next = self.goto[state].get(character)
+                if next is None:
+                    next = self.goto[state][character] = len(self.goto)
+                    self.goto.append({})
+                    self.depth.append(self.depth[state] + 1)
+                    self.phone.append(None)
+                state = next
+            self.phone[state] = phone
+        # Compute failure and output links breadth-first, so the links of
+        # shallower states are known when deeper states need them.
+        self.fail = [0] * len(self.goto)
+        self.output = [0] * len(self.goto)
+        queue = self.goto[0].values()
+        for state in queue:
+            for character, next in self.goto[state].iteritems():
+                fail = self.fail[state]
+                while fail and character not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(character, 0)
+                self.fail[next] = fail
+                if self.phone[fail] is not None:
+                    self.output[next] = fail
+                else:
+                    self.output[next] = self.output[fail]
+                queue.append(next)
+
+    def matches(self, text):
+        # Generate (POSITION, NEXT, PHONE) for every known PHONE occurring
+        # in TEXT as TEXT[POSITION:NEXT].
+        goto = self.goto
+        fail = self.fail
+        state = 0
+        for next, character in enumerate(text):
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            if self.phone[state] is None:
+                found = self.output[state]
+            else:
+                found = state
+            while found:
+                yield (next + 1 - self.depth[found], next + 1,
+                       self.phone[found])
+                found = self.output[found]
+
+    def words(self, phone):
+        return self.phone_words[phone]
+
+    def write(self, output):
+        # Save the automaton as a binary phone index, see Phone_index.
+        phones = []
+        numbers = {}
+        for phone in self.phone:
+            if phone is not None:
+                numbers[phone] = len(phones)
+                phones.append(phone)
+        states = []
+        characters = []
+        targets = []
+        for state, goto in enumerate(self.goto):
+            phone = self.phone[state]
+            if phone is None:
+                number = 0
+            else:
+                number = numbers[phone] + 1
+            states.append(struct.pack(
+                index_state_format, len(characters), self.fail[state],
+                self.output[state], number, self.depth[state], len(goto)))
+            for character in sorted(goto):
+                characters.append(character)
+                targets.append(goto[character])
+        offsets = []
+        words = []
+        size = 0
+        for phone in phones:
+            offsets.append(size)
+            bucket = '\n'.join(self.phone_words[phone])
+            words.append(bucket)
+            size += len(bucket)
+        offsets.append(size)
+        sections = (''.join(states), ''.join(characters),
+                    struct.pack('<%dI' % len(targets), *targets),
+                    struct.pack('<%dI' % len(offsets), *offsets),
+                    ''.join(words))
+        header = [index_magic]
+        offset = len(index_magic) + struct.calcsize(index_header_format)
+        for section in sections:
+            header.append(struct.pack('<I', offset))
+            offset += len(section)
+        output.write(''.join(header))
+        for section in sections:
+            output.write(section)
+        output.flush()
+
+# A binary phone index starts with INDEX_MAGIC, followed by the offsets of
+# five sections: states, characters, targets, phone buckets and words.  The
+# states section has one INDEX_STATE_FORMAT record per automaton state:
+# its first edge, failure state, output state, phone number plus one (or
+# 0), depth and edge count.  Edges of a state are consecutive and sorted,
+# the characters section has one character per edge, the targets section
+# the corresponding 32-bit target state.  Phone buckets have 32-bit offsets
+# into the words section, one per phone plus a final one; each bucket holds
+# its words separated by newlines.  All numbers are little-endian.
+index_magic = 'Autopun index 1\n'
+index_header_format = '<5I'
+index_state_format = '<4I2H'
+
+class Phone_trie:
+    # Phones of a changing vocabulary, within a trie of nested dictionaries
+    # indexed by phone characters, a phone ending where the '' key exists.
+    # PHONES maps a canonical word to its (KEY, PHONE), the KEY being what
+    # goes into puns.  PHONE_WORDS maps a phone to a tuple of keys.  The
+    # GENERATION increases whenever a phone appears or vanishes.
+    #
+    # Translating keys takes time, so changes told by the database only
+    # get queued in PENDING, as (WORD, KEY) pairs, KEY being None for a
+    # removal, or (None, WORDS) for a reset.  `update' later applies them.
+    # WAKE, if not None, gets called when PENDING stops being empty.
+
+    def __init__(self):
+        self.root = {}
+        self.phones = {}
+        self.phone_words = {}
+        self.generation = 0
+        self.pending = collections.deque()
+        self.wake = None
+
+    def add(self, word, key):
+        self.queue(word, key)
+
+    def remove(self, word):
+        self.queue(word, None)
+
+    def reset(self, words):
+        # WORDS maps every known word to its key.
+        self.queue(None, words)
+
+    def queue(self, word, key):
+        self.pending.append((word, key))
+        if len(self.pending) == 1 and self.wake is not None:
+            self.wake()
+
+    def update(self, budget=None):
+        # Apply pending changes while BUDGET lasts.  Return True if none
+        # remains.
+        while self.pending:
+            if budget is not None and not budget.spend():
+                return False
+            word, key = self.pending.popleft()
+            if word is not None:
+                if key is None:
+                    self.delete(word)
+                else:
+                    self.insert(word, key)
+                continue
+            # Forget vanished words, then only translate the new keys.
+            words = key
+            for word in self.phones.keys():
+                if word not in words:
+                    self.delete(word)
+            changes = [(word, key) for word, key in words.iteritems()
+                       if self.phones.get(word, (None,))[0] != key]
+            changes.reverse()
+            self.pending.extendleft(changes)
+        return True
+
+    def insert(self, word, key):
+        if word in self.phones:
+            if self.phones[word][0] == key:
+                return
+            self.delete(word)
+        import unicodedata
+        text = unicodedata.normalize('NFKD', unicode(key))
+        phone = xlate_line(text.encode('ASCII', 'ignore'))
+        phone = phone.translate(run.squash_table)
+        if not phone:
+            return
+        self.phones[word] = key, phone
+        if phone in self.phone_words:
+            self.phone_words[phone] += key,
+        else:
+            self.phone_words[phone] = key,
+            node = self.root
+            for character in phone:
+                if character not in node:
+                    node[character] = {}
+                node = node[character]
+            node[''] = phone
+            self.generation += 1
+
+    def delete(self, word):
+        if word not in self.phones:
+            return
+        key, phone = self.phones.pop(word)
+        keys = list(self.phone_words[phone])
+        keys.remove(key)
+        if keys:
+            self.phone_words[phone] = tuple(keys)
+        else:
+            del self.phone_words[phone]
+            # Prune the branch of nodes left empty.
+            nodes = [self.root]
+            for character in phone:
+                nodes.append(nodes[-1][character])
+            del nodes[-1]['']
+            for character in reversed(phone):
+                node = nodes.pop()
+                if node:
+                    break
+                del nodes[-1][character]
+            self.generation += 1
+
+    def matches(self, text):
+        # Generate (POSITION, NEXT, PHONE) for every known PHONE occurring
+        # in TEXT as TEXT[POSITION:NEXT].
+        for position in range(len(text)):
+            node = self.root
+            next = position
+            while next < len(text):
+                node = node.get(text[next])
+                if node is None:
+                    break
+                next += 1
+                if '' in node:
+                    yield position, next, node['']
+
+    def words(self, phone):
+        return self.phone_words[phone]
+
+class Phone_index:
+    # Automaton read from a binary phone index mapped in memory.  It is
+    # walked directly within the mapping, so nothing is loaded beforehand,
+    # only the word buckets met are decoded and remembered.
+
+    def __init__(self, name):
+        import mmap
+        handle = file(name, 'rb')
+        self.map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        handle.close()
+        (self.states, self.characters, self.targets, self.buckets,
+         self.words_offset) = struct.unpack_from(
+            index_header_format, self.map, len(index_magic))
+        self.state_size = struct.calcsize(index_state_format)
+        self.phone_words = {}
+
+    def state(self, state):
+        return struct.unpack_from(index_state_format, self.map,
+                                  self.states + self.state_size * state)
+
+    def matches(self, text):
+        # Generate (POSITION, NEXT, PHONE) for every known PHONE occurring
+        # in TEXT as TEXT[POSITION:NEXT].
+        state = 0
+        first, fail, output, number, depth, count = self.state(state)
+        for next, character in enumerate(text):
+            edge = self.edge(first, count, character)
+            while edge is None and state:
+                state = fail
+                first, fail, output, number, depth, count = self.state(state)
+                edge = self.edge(first, count, character)
+            if edge is None:
+                state = 0
+            else:
+                state = edge
+            first, fail, output, number, depth, count = self.state(state)
+            if number:
+                found = state
+            else:
+                found = output
+            while found:
+                found_output, found_number, found_depth = (
+                    self.state(found)[2:5])
+                position = next + 1 - found_depth
+                phone = text[position:next + 1]
+                if phone not in self.phone_words:
+                    self.phone_words[phone] = self.bucket(found_number - 1)
+                yield position, next + 1, phone
+                found = found_output
+
+    def edge(self, first, count, character):
+        # Return the state reached through CHARACTER, or None.
+        start = self.characters + first
+        edge = self.map.find(character, start, start + count)
+        if edge >= 0:
+            return struct.unpack_from(
+                '<I', self.map, self.targets + 4 * (edge - self.characters))[0]
+
+    def bucket(self, number):
+        start, end = struct.unpack_from('<2I', self.map,
+                                        self.buckets + 4 * number)
+        return tuple(self.map[self.words_offset + start:
+                              self.words_offset + end].split('\n'))
+
+    def words(self, phone):
+        return self.phone_words[phone]
 
 # Phonetic tools.
 
-def xlate_line(text):
+class Timeout(Exception):
+    pass
+
+def convert_chunk(arguments):
+    # Convert a list of words into (WORD, PHONE, REASON) triplets, where
+    # PHONE is None if WORD is rejected, REASON then telling why.  Each word
+    # may take at most TIME_LIMIT seconds.
+    words, time_limit = arguments
+
+    def interrupt(number, frame):
+        raise Timeout
+
+    previous = signal.signal(signal.SIGALRM, interrupt)
+    results = []
+    for word in words:
+        if not word:
+            continue
+        try:
+            signal.setitimer(signal.ITIMER_REAL, time_limit)
+            phone = translate_word(word).translate(run.squash_table)
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        except Timeout:
+            # The timer is one-shot, so it cannot fire again.
+            results.append((word, None, 'timeout'))
+            continue
+        if phone:
+            results.append((word, phone, None))
+        else:
+            results.append((word, None, 'no-phone'))
+    signal.signal(signal.SIGALRM, previous)
+    return results
+
+def bounded_imap(pool, function, items, window):
+    # Same as `pool.imap', but with at most WINDOW items being processed or
+    # waiting to be consumed, so ITEMS only get read as results get used.
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def read_chunks(input, size):
+    # Generate lists of at most SIZE lines read from INPUT.
+    chunk = []
+    for line in input:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def pun_chunk(lines):
+    # Pun a list of lines into (TEXT, PUN, SECONDS) triplets, where TEXT is
+    # the line without its newline, PUN is None if none was found, and
+    # SECONDS is the time it took.
+    results = []
+    for line in lines:
+        text = line.rstrip('\n')
+        start = time.time()
+        pun = run.produce_some_pun(text)
+        results.append((text, pun, time.time() - start))
+    return results
+
+def write_histogram(title, counts):
+    if not counts:
+        return
+    sys.stderr.write('%s:\n' % title)
+    total = sum(counts.itervalues())
+    width = max(counts.itervalues())
+    for length in sorted(counts):
+        sys.stderr.write('%5d %7d %5.1f%% %s\n'
+                         % (length, counts[length],
+                            100. * counts[length] / total,
+                            '*' * (50 * counts[length] // width)))
+
+class Budget:
+    # Limit some work to SECONDS of elapsed time, None meaning unlimited.
+    # The work may also be cancelled, possibly from another thread.  A
+    # budget may be part of a PARENT budget.
+
+    def __init__(self, seconds=None, parent=None):
+        if seconds is None:
+            self.deadline = None
+        else:
+            self.deadline = time.time() + seconds
+        self.parent = parent
+        self.cancelled = False
+        self.exhausted = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def part(self, fraction):
+        # Return a budget for FRACTION of what remains of this one.
+        if self.deadline is None:
+            seconds = None
+        else:
+            seconds = fraction * max(self.deadline - time.time(), 0)
+        return Budget(seconds, self)
+
+    def spend(self):
+        # Account for one more step, return True if work may go on.
+        if self.cancelled or self.exhausted:
+            return False
+        if (self.parent is not None and not self.parent.spend()
+                or self.deadline is not None and time.time() > self.deadline):
+            self.exhausted = True
+            return False
+        return True
+
+def xlate_line(text, budget=None):
     # Given an English-text phrase or word, translate that thing into a
-    # phoneme-list.
+    # phoneme-list.  If BUDGET gets exhausted, only translate the words
+    # seen so far.
     phone = ''
     word = ''
     for character in text:
         if character.isalpha() or character == '\'':
             word += character
         elif word:
+            if budget is not None and not budget.spend():
+                return phone
             phone += xlate_word(word)
             word = ''
-    if word:
+    if word and (budget is None or budget.spend()):
         phone += xlate_word(word)
     return phone
 
+# Chat vocabulary is highly repetitive, so remember recent translations.
+translations = common.Cache(10000)
+
+def statistics():
+    return "Translation cache: " + translations.report()
+
+def pun_statistics():
+    return "Pun cache: " + run.pun_cache.report()
+
+common.statistics.append(statistics)
+common.statistics.append(pun_statistics)
+
 def xlate_word(word):
     # Translate the given English word into a phoneme stream.  The word
     # contains only letters, apostrophes, and hyphens.
+    phone = translations.get(word)
+    if phone is None:
+        phone = translations[word] = translate_word(word)
+    return phone
+
+def translate_word(word):
+    # Do the work of xlate_word, using compiled rules.
+    phone = ''
+    word = ' ' + word.upper() + ' '
+    # Left contexts are matched over the word read backwards.  Doubling it
+    # mimics the wrap-around of negative indices in Rule.leftmatch.
+    backward = word[::-1] * 2
+    size = len(word)
+    position = 1
+    while position < size:
+        for rule in Rule.rules_by_first.get(word[position], ()):
+            if (rule.right.match(word, position)
+                    and (rule.left is None
+                         or rule.left.match(backward, size - position))):
+                phone += rule.phone
+                position += len(rule.string)
+                break
+        else:
+            # Skip the annoyance.
+            position += 1
+    return phone[:-1]
+
+def interpret_word(word):
+    # Reference translation interpreting the rules, for checking.
     phone = ''
     word = ' ' + word.upper() + ' '
     position = 1
@@ -224,7 +1117,7 @@ def xlate_word(word):
                 break
         else:
             # Skip the annoyance.
-            position =+ 1
+            position += 1
     return phone[:-1]
 
 class Phonemes:
@@ -295,7 +1188,9 @@ class Rule:
     #   . - One of B, D, V, G, J, L, M, N, R, W or Z (voiced consonants)
     #   % - One of ER, E, ES, ED, ING, ELY (a suffix) (in right context only)
     #   + - One of E, I or Y (a "front" vowel)
-    # Phonemes are recoded into a phone string.
+    # Phonemes are recoded into a phone string.  RIGHT is a regular
+    # expression matching the string and its right context, LEFT matches
+    # the left context read backwards, or is None.
 
     rules_by_first = {}
 
@@ -303,9 +1198,13 @@ class Rule:
         self.string = string
         if isinstance(prefix, str):
             self.prefix = prefix[::-1]
+            self.left = re.compile(compile_context(self.prefix))
         else:
             self.prefix = prefix
+            self.left = None
         self.suffix = suffix
+        self.right = re.compile(re.escape(string)
+                                + compile_context(suffix or ''))
         self.phone = Phonemes.phonemes_to_phone(phonemes)
         rules = Rule.rules_by_first.get(string[0])
         if rules is None:
@@ -404,6 +1303,36 @@ class Rule:
                 assert False, character
         return True
 
+def compile_context(pattern):
+    # Turn a context pattern into a regular expression.  Rule.leftmatch and
+    # Rule.rightmatch never backtrack, so repetitions and the suffix choice
+    # are made atomic, as in (?=(X+))\1.
+    vowel = '[AEIOU]'
+    consonant = '[B-DF-HJ-NP-TV-Z]'
+    fragments = []
+    groups = 0
+    for character in pattern:
+        if character == '#':
+            atomic = vowel + '+'
+        elif character == ':':
+            atomic = consonant + '*'
+        elif character == '%':
+            atomic = 'ED|ELY|ER|ES|E|ING'
+        else:
+            atomic = None
+            if character == '^':
+                fragments.append(consonant)
+            elif character == '.':
+                fragments.append('[BDVGJLMNRWZ]')
+            elif character == '+':
+                fragments.append('[EIY]')
+            else:
+                fragments.append(re.escape(character))
+        if atomic is not None:
+            groups += 1
+            fragments.append('(?=(%s))\\%d' % (atomic, groups))
+    return ''.join(fragments)
+
 def isvowel(character):
     return character in 'AEIOU'
 
@@ -21,10 +21,14 @@ Usage: cabot [OPTION] [SERVER]
 
 Options:
   -h           Print this help page and exit.
+  -c DAYS      Compact the database, archiving deletions older than DAYS.
   -l SOURCE    Load data from standard input (adding stamps and SOURCE).
   -e SOURCE    Erase entries when from SOURCE, and dump them.
   -d           Dump the whole database to standard output.
   -u           Undump (a partial) database from standard input.
+  -z           With -d or -r, dump in compressed and checksummed chunks.
+  -m           Migrate the Berkeley DB database into SQLite.
+  -r STAMP     Dump changes made since STAMP, for incremental backups.
 
 Unless special options are used, the bot installs under name `cabot' within
 channels `#cabot' and `#icule' on SERVER, or if SERVER is not given, according
@@ -60,10 +64,13 @@ class Main:
     def main(self, *arguments):
         # Decode arguments.
         program = None
+        compressed = False
         import getopt
-        options, arguments = getopt.getopt(arguments, 'de:hl:u')
+        options, arguments = getopt.getopt(arguments, 'c:de:hl:mr:uz')
         for option, value in options:
-            if option == '-d':
+            if option == '-c':
+                program = database.compact_database, value
+            elif option == '-d':
                 program = database.dump_database,
             elif option == '-e':
                 program = database.erase_entries, value
@@ -72,8 +79,14 @@ class Main:
                 return
             elif option == '-l':
                 program = database.load_entries, value
+            elif option == '-m':
+                program = database.migrate_database,
+            elif option == '-r':
+                program = database.dump_changes, value
             elif option == '-u':
                 program = database.undump_database,
+            elif option == '-z':
+                compressed = True
         if program is None:
             if arguments:
                 program = self.start_bot, arguments[0]
@@ -81,6 +94,10 @@ class Main:
             else:
                 program = self.start_bot, os.environ['IRCSERVER']
         assert not arguments, arguments
+        if compressed:
+            assert program[0] in (database.dump_database,
+                                  database.dump_changes), program
+            program += True,
         sys.stdout = codecs.getwriter(file_encoding)(
             sys.stdout, 'backslashreplace')
         sys.stderr = codecs.getwriter(file_encoding)(
@@ -92,6 +109,10 @@ class Main:
         try:
             common.server.start()
         except KeyboardInterrupt:
+            # Abandon puns in progress.  Sync pending changes, so the next
+            # start finds the word index current.
+            common.Command.registry['pun'].cancel()
+            database.database.commit()
             common.server.die()
 
 run = Main()
@@ -120,6 +141,12 @@ class Server(ircbot.SingleServerIRCBot):
         self.joins = CHANNELS
         ircbot.SingleServerIRCBot.__init__(
             self, [(irc_server, 6667)], NAME_PASSWORD[0], NAME_PASSWORD[0])
+        common.statistics.append(self.statistics)
+
+    def statistics(self):
+        return ("Timers: %(pending)d pending, %(cancelled)d cancelled,"
+                " %(executed)d executed, %(peak)d peak"
+                % self.ircobj.delayed_statistics())
 
     def on_nicknameinuse(self, connection, event):
         connection.nick(connection.get_nickname() + "_")
@@ -157,14 +184,17 @@ class Server(ircbot.SingleServerIRCBot):
                 encoding = 'ISO-8859-1'
             line = line.decode('ISO-8859-1')
         # Set SOURCE to the requesting nick.  Set TARGET to either a nick or
-        # channel, where the command output should go.
+        # channel, where the command output should go, WRITER to the way to
+        # write there and ENCODING to the encoding to use.  Commands may
+        # save these for replying later, see `reply'.
         self.source = irclib.nm_to_n(event.source())
+        self.encoding = encoding
         if private:
-            writer = connection.notice
+            writer = self.writer = connection.notice
             self.target = self.source
             code = '/'
         else:
-            writer = connection.privmsg
+            writer = self.writer = connection.privmsg
             self.target = event.target()
             code, line = find_command(connection, line)
             if code is None:
@@ -216,28 +246,31 @@ class Server(ircbot.SingleServerIRCBot):
             text = ''.join(fragments)
             if code == '?':
                 text = common.choice(5, text, self.source + ': ' + text)
-            # Clean spurious white space.
-            lines = [line.rstrip() for line in text.splitlines()]
-            while lines and not lines[-1]:
-                del lines[-1]
-            while lines and not lines[0]:
-                del lines[0]
-            if lines:
-                # Append lines to proper NICK's queue.
-                if self.target in self.queues:
-                    queue = self.queues[self.target]
-                else:
-                    queue = self.queues[self.target] = Queue()
-                    if self.target not in self.targets:
-                        self.targets.append(self.target)
-                queue.save_lines(writer, self.target, lines, encoding)
-                # Restart output if not already in progress.
-                if queue and not self.output_active:
-                    self.send_something()
+            self.reply(writer, self.target, encoding, text)
             common.Log('%s: %r -> %r\n' % (self.target, line, text))
         else:
             common.Log('%s: %r!\n' % (self.target, line))
 
+    def reply(self, writer, target, encoding, text):
+        # Clean spurious white space.
+        lines = [line.rstrip() for line in text.splitlines()]
+        while lines and not lines[-1]:
+            del lines[-1]
+        while lines and not lines[0]:
+            del lines[0]
+        if lines:
+            # Append lines to proper NICK's queue.
+            if target in self.queues:
+                queue = self.queues[target]
+            else:
+                queue = self.queues[target] = Queue()
+                if target not in self.targets:
+                    self.targets.append(target)
+            queue.save_lines(writer, target, lines, encoding)
+            # Restart output if not already in progress.
+            if queue and not self.output_active:
+                self.send_something()
+
     def send_something(self):
         # How many lines can we burst together without flooding?
         now = time.time()
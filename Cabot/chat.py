@@ -54,6 +54,13 @@ class More(Command):
             if selver.target not in server.targets:
                 server.targets.insert(0, server.target)
 
+class Stats(Command):
+    "stats (cache statistics)."
+
+    def handler(self, write, *arguments):
+        for function in common.statistics:
+            write(function() + '\n')
+
 class Error(Command):
     # Turn a message into an error.
 
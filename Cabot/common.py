@@ -25,6 +25,9 @@ datadir = '/home/pinard/net/cabot/database'
 # SERVER is set, within `cabot.py', to the single Server instance.
 server = None
 
+# Functions returning a line of statistics, listed by the `stats' command.
+statistics = []
+
 class Error(Exception):
     pass
 
@@ -128,6 +131,51 @@ class Log:
 
 ## Miscellaneous services.
 
+class Cache:
+    # Mapping holding at most SIZE entries, dropping the least recently used.
+    # HITS and MISSES count `get' outcomes, to help sizing the cache.
+
+    def __init__(self, size):
+        from collections import OrderedDict
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __setitem__(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(False)
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def report(self):
+        total = self.hits + self.misses
+        if total:
+            ratio = 100. * self.hits / total
+        else:
+            ratio = 0.
+        return ("%d/%d entries, %d hits, %d misses (%.1f%% hits)"
+                % (len(self.entries), self.size, self.hits, self.misses, ratio))
+
 def choice(*arguments):
     total = 0
     weight = 1
@@ -144,7 +192,30 @@ def choice(*arguments):
         if cut < partial:
             return text
 
-def timestamp():
-    y, mo, d, h, mi, s = time.localtime()[:6]
+def timestamp(seconds=None):
+    y, mo, d, h, mi, s = time.localtime(seconds)[:6]
     y -= 2000
     return '%.2d%.2d%.2d%.2d%.2d%.2d' % (y, mo, d, h, mi, s)
+
+# Microseconds since the epoch and sequence number of the last unique stamp.
+previous_micro = 0
+sequence = 0
+
+def unique_timestamp():
+    # Return `timestamp()' followed by six digits of microseconds and a
+    # three-digit sequence number.  Stamps increase strictly within a
+    # process, even if the clock stalls or goes back, and sort after any
+    # plain `timestamp()' for the same second.
+    global previous_micro, sequence
+    micro = int(time.time() * 1000000)
+    if micro > previous_micro:
+        sequence = 0
+    else:
+        micro = previous_micro
+        sequence += 1
+        if sequence == 1000:
+            micro += 1
+            sequence = 0
+    previous_micro = micro
+    seconds, fraction = divmod(micro, 1000000)
+    return '%s%.6d%.3d' % (timestamp(seconds), fraction, sequence)
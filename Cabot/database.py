@@ -22,9 +22,10 @@ Handle Cabot databases and logs.
 
 # Each database entry relates a key to a value, or more precisely a
 # `KEY\0STAMP' to a `SOURCE\0VALUE'.  Users see only WORD and VALUE.  STAMP is
-# `YYMMDDhhmmss' and is used to order duplicate entries.  SOURCE is either a
-# nickname or by convention, a '@' followed by a keyword indicating another
-# type of source.
+# `YYMMDDhhmmss' and is used to order duplicate entries.  Newer stamps add
+# microseconds and a sequence number, as `YYMMDDhhmmssuuuuuuNNN', and are
+# unique within the writing process.  SOURCE is either a nickname or by
+# convention, a '@' followed by a keyword indicating another type of source.
 
 # `\0DSTAMP' for a key signals a deleted entry, DSTAMP tells delete time.
 # The value is `DSOURCE\0KEY\0STAMP\0SOURCE\0VALUE', where DSOURCE is the
@@ -34,28 +35,213 @@ Handle Cabot databases and logs.
 # `KEY\0STAMP' are preceded by a record having `KEY' for a key and '' for
 # a value.  This record might disappear in some future.
 
+# The mapping from canonical words to raw keys is saved next to the database,
+# in `db.index' for a snapshot and `db.index-log' for changes made since.
+# Both carry a stamp describing the database file as it was when they got
+# written, so an index made stale by an external update gets rebuilt.
+
+# When the bot writes, changes reach the B-tree at once but the B-tree only
+# gets synced to disk once in a while, a group commit.  Meanwhile, changes
+# are also appended to `db.journal', which is replayed whenever the database
+# is opened for writing.
+
 __metaclass__ = type
-import bsddb, re, sys
+import marshal, os, re, struct, sys, time, zlib
 import common
 
+try:
+    import bsddb
+except ImportError:
+    bsddb = None
+
 file_encoding = 'UTF-8'
 NUL = '\0'
 
+# Compaction archives deletion records older than this many days.
+retention_days = 90
+# Compaction refuses to archive deletion records younger than this.
+minimum_retention_days = 7
+# Nicks allowed to compact over IRC, or empty to allow anyone.  In any case,
+# compaction is only accepted through private messages.
+compact_admins = ()
+
 ## Utility programs.
 
-def dump_database():
+# A compressed dump starts with DUMP_MAGIC.  Then each chunk has a header
+# giving its compressed length and the CRC-32 of its uncompressed contents,
+# followed by zlib-compressed records.  Each record is the UTF-8 encoded
+# length of its key and value, then the key and value themselves.  A header
+# with a zero length ends the dump, the CRC-32 field then tells the number
+# of records.  Lengths, CRC-32s and counts are big-endian 32-bit numbers.
+dump_magic = 'Cabot dump 1\n'
+dump_chunk_size = 1 << 20
+
+def dump_database(compressed=False):
     db = Unicode_database('r')
-    for key, value in db:
-        sys.stdout.write('%s\t%s\n' % (key, value))
+    write_dump(db, compressed)
+    db.close()
+
+def dump_changes(stamp, compressed=False):
+    # Dump additions and deletions since STAMP, for incremental backups.
+    db = Unicode_database('r')
+    write_dump(db.changes_since(stamp), compressed)
     db.close()
 
+def write_dump(pairs, compressed):
+    progress = Progress('dumped')
+    if compressed:
+        # Bypass the Unicode writer installed on standard output.
+        writer = Chunk_writer(getattr(sys.stdout, 'stream', sys.stdout))
+        for key, value in pairs:
+            writer.write(key, value)
+            progress.update(1, len(key) + len(value))
+        writer.close()
+    else:
+        for key, value in pairs:
+            sys.stdout.write('%s\t%s\n' % (key, value))
+            progress.update(1, len(key) + len(value))
+    progress.finish()
+
 def undump_database():
     db = Unicode_database('c')
-    for line in sys.stdin:
-        line = line.decode(file_encoding)
-        key, value = line.split('\t')
-        db[key] = value.rstrip()
+    progress = Progress('undumped')
+    line = sys.stdin.readline()
+    if line == dump_magic:
+        for pairs in read_chunks(sys.stdin):
+            # Keys come sorted from a full dump, sorting chunks also helps
+            # incremental dumps, which are in stamp order.
+            pairs.sort()
+            size = 0
+            for key, value in pairs:
+                restore_record(db, key, value)
+                size += len(key) + len(value)
+            db.commit()
+            progress.update(len(pairs), size)
+    else:
+        while line:
+            line = line.decode(file_encoding)
+            key, value = line.split('\t')
+            value = value.rstrip()
+            restore_record(db, key, value)
+            progress.update(1, len(key) + len(value))
+            line = sys.stdin.readline()
     db.close()
+    progress.finish()
+
+def restore_record(db, key, value):
+    if NUL in key:
+        # An incremental dump has no group records, restore them.
+        group = key.split(NUL, 1)[0]
+        if not db.has_key(group):
+            db[group] = ''
+        if not group:
+            # Replaying a deletion, also delete what it describes.
+            deleted_key, deleted_stamp = value.split(NUL)[1:3]
+            if db.has_key(deleted_key + NUL + deleted_stamp):
+                db.delete_entry(deleted_key, deleted_stamp)
+    db[key] = value
+
+class Chunk_writer:
+
+    def __init__(self, output):
+        self.output = output
+        self.output.write(dump_magic)
+        self.records = []
+        self.size = 0
+        self.count = 0
+
+    def write(self, key, value):
+        key = key.encode(file_encoding)
+        value = value.encode(file_encoding)
+        self.records.append(struct.pack('>II', len(key), len(value)))
+        self.records.append(key)
+        self.records.append(value)
+        self.size += 8 + len(key) + len(value)
+        self.count += 1
+        if self.size >= dump_chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.records:
+            data = ''.join(self.records)
+            compressed = zlib.compress(data)
+            self.output.write(struct.pack('>II', len(compressed),
+                                          zlib.crc32(data) & 0xffffffff))
+            self.output.write(compressed)
+            self.records = []
+            self.size = 0
+
+    def close(self):
+        self.flush()
+        self.output.write(struct.pack('>II', 0, self.count))
+        self.output.flush()
+
+def read_chunks(input):
+    # Produce a list of (KEY, VALUE) pairs per chunk, once checked.
+    count = 0
+    chunk = 0
+    while True:
+        header = input.read(8)
+        if len(header) < 8:
+            raise common.Error("Dump truncated after chunk %d" % chunk)
+        length, checksum = struct.unpack('>II', header)
+        if not length:
+            if checksum != count:
+                raise common.Error("Dump has %d records, %d expected"
+                                   % (count, checksum))
+            return
+        chunk += 1
+        compressed = input.read(length)
+        if len(compressed) < length:
+            raise common.Error("Dump truncated in chunk %d" % chunk)
+        try:
+            data = zlib.decompress(compressed)
+        except zlib.error:
+            data = None
+        if data is None or zlib.crc32(data) & 0xffffffff != checksum:
+            raise common.Error("Dump chunk %d is corrupted" % chunk)
+        pairs = []
+        position = 0
+        while position < len(data):
+            key_length, value_length = struct.unpack_from(
+                '>II', data, position)
+            position += 8
+            key = data[position:position+key_length]
+            position += key_length
+            value = data[position:position+value_length]
+            position += value_length
+            pairs.append((key.decode(file_encoding),
+                          value.decode(file_encoding)))
+        count += len(pairs)
+        yield pairs
+
+class Progress:
+    # Report the number of records and bytes going through on standard
+    # error, along with throughput, about once per second.
+
+    def __init__(self, verb):
+        self.verb = verb
+        self.count = 0
+        self.size = 0
+        self.start = self.reported = time.time()
+
+    def update(self, count, size):
+        self.count += count
+        self.size += size
+        now = time.time()
+        if now - self.reported >= 1:
+            self.reported = now
+            sys.stderr.write('\r' + self.line(now))
+
+    def finish(self):
+        sys.stderr.write('\r' + self.line(time.time()) + '\n')
+
+    def line(self, now):
+        elapsed = max(now - self.start, 1e-6)
+        return ("%d records %s, %.1f MB in %.1f seconds"
+                " (%.0f records/s, %.2f MB/s)"
+                % (self.count, self.verb, self.size / 1e6, elapsed,
+                   self.count / elapsed, self.size / 1e6 / elapsed))
 
 def load_entries(source):
     pairs = []
@@ -69,11 +255,76 @@ def load_entries(source):
 
 def erase_entries(source):
     db = Unicode_database('w')
-    db.delete_entries(source)
+    for key, value in db.delete_entries(source):
+        sys.stdout.write('%s\t%s\n' % (key, value))
+    db.close()
+
+def compact_database(days):
+    db = Unicode_database('w')
+    dropped, report = db.compact(int(days))
     db.close()
+    sys.stderr.write(report + '\n')
+
+def migrate_database():
+    # Stream the Berkeley DB database into a new SQLite database.
+    source = Unicode_database('w', backend='bsddb')
+    target = Sqlite_storage(source.name + '.sqlite', 'n')
+    progress = Progress('migrated')
+    for key, value in source:
+        target.put(key, value)
+        progress.update(1, len(key) + len(value))
+        if progress.count % 10000 == 0:
+            target.sync()
+    target.close()
+    source.close()
+    progress.finish()
 
 ## Database commands.
 
+class Compact(common.Command):
+    # COMPACT [DAYS] - archive old deletions and rewrite the database.
+    number_arguments = 0, 1
+
+    def handler(self, write, days=None):
+        if days is None:
+            days = retention_days
+        elif days.isdigit():
+            days = int(days)
+        else:
+            raise common.Error("%s is not a number of days" % days)
+        if days < minimum_retention_days:
+            raise common.Error("Keeping less than %d days is unsafe"
+                               % minimum_retention_days)
+        if common.server is None:
+            write(database.compact(days) + '\n')
+            return
+        server = common.server
+        if server.target != server.source:
+            raise common.Error("Compaction is only for private messages")
+        if compact_admins and server.source not in compact_admins:
+            raise common.Error("Compaction is reserved to administrators")
+        if database.compacting:
+            raise common.Error("Compaction is already running")
+        # Compacting a big database takes a while, reply later.
+        context = server.writer, server.target, server.encoding
+
+        def reply(report):
+            server.reply(*(context + (report + '\n',)))
+
+        def fail(*exc_info):
+            if issubclass(exc_info[0], common.Error):
+                fragments = []
+                common.Command.error_handler(fragments.append,
+                                             str(exc_info[1]))
+                reply(''.join(fragments).rstrip('\n'))
+            else:
+                import traceback
+                traceback.print_exception(*(exc_info + (None, sys.stderr)))
+
+        database.compact_in_thread(days, reply, fail)
+        # Stop any further burp.
+        write('')
+
 class Close(common.Command):
     # CLOSE database - useful to force a re-read after an external update.
     number_arguments = 1
@@ -175,6 +426,50 @@ class Learn(common.Command):
                               "created.")
         write('%s\n' % reply)
 
+class Apropos(common.Command):
+    "apropos WORD... (search definitions)."
+    number_arguments = 1, None
+
+    def handler(self, write, *words):
+        keys = database.search(words)
+        if keys:
+            write(' '.join(keys) + '\n')
+        else:
+            raise common.Error("Nothing found about %s" % ' '.join(words))
+
+class Recent(common.Command):
+    "recent [STAMP|NUMBER[mhd]] (changes since, default 1h)."
+    number_arguments = 0, 1
+    units = {'m': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+    def handler(self, write, since='1h'):
+        match = re.match('([0-9]+)([mhd])$', since)
+        if match:
+            since = common.timestamp(
+                time.time() - int(match.group(1)) * self.units[match.group(2)])
+        elif not since.isdigit():
+            raise common.Error("%s is neither a stamp nor a delay" % since)
+        changes = database.changes_since(since)
+        if not changes:
+            raise common.Error("Nothing changed since %s" % since)
+        for stamp, source, key, value in changes:
+            if key:
+                write('%s +%s (%s)\n' % (stamp[:12], key, source))
+            else:
+                key = value.split(NUL, 1)[0]
+                write('%s -%s (%s)\n' % (stamp[:12], key, source))
+
+class Source(common.Command):
+    "source NICK (keys from NICK)."
+    number_arguments = 1
+
+    def handler(self, write, source):
+        keys = database.keys_by_source(source)
+        if keys:
+            write(' '.join(keys) + '\n')
+        else:
+            raise common.Error("Nothing comes from %s" % source)
+
 class Unlearn(common.Command):
     "forget KEY [N[-M]]|[all] (unlearn)."
     extra_keywords = 'del', 'delete', 'forget'
@@ -219,9 +514,20 @@ class Unlearn(common.Command):
 ## Database handling.
 
 class Database:
+    commit_delay = 2
+    cache_size = 1000
+
     def __init__(self):
         self.db = None
         self.word_to_keys = None
+        self.trigrams = None
+        self.commit_scheduled = False
+        self.compacting = False
+        # Sorted (KEY, VALUE) lists, as produced by `getall', indexed by
+        # canonical word.
+        self.cache = common.Cache(self.cache_size)
+        # Objects following canonical words, see `add_word_listener'.
+        self.word_listeners = []
 
     def __iter__(self):
         if self.db is None:
@@ -246,21 +552,52 @@ class Database:
         if self.db is None:
             self.open()
         pattern = self.canonical_key(pattern)
+        words = self.trigrams.candidates(pattern)
+        if words is None:
+            # Pattern too short to have trigrams, scan all words.
+            words = self.word_to_keys.iterkeys()
         results = []
-        for word, keys in self.word_to_keys.iteritems():
+        for word in sorted(words):
             if pattern in word:
-                results.append(keys[0])
+                results.append(self.word_to_keys[word][0])
         return results
 
+    def changes_since(self, stamp):
+        if self.db is None:
+            self.open()
+        return list(self.db.changes_since_stamp(stamp))
+
+    def keys_by_source(self, source):
+        if self.db is None:
+            self.open()
+        keys = set()
+        for stamp, source, key, value in self.db.entries_by_source(source):
+            if key:
+                keys.add(key)
+        return sorted(keys)
+
+    def search(self, words):
+        if self.db is None:
+            self.open()
+        keys = set()
+        for stamp, source, key, value in self.db.search_entries(words):
+            keys.add(key)
+        return sorted(keys)
+
     def getall(self, key):
         if self.db is None:
             self.open()
-        results = []
-        for key in self.word_to_keys.get(self.canonical_key(key), []):
-            for result in self.db.get_entries(key):
-                results.append(result)
-        results.sort()
-        for stamp, source, key, value in results:
+        word = self.canonical_key(key)
+        pairs = self.cache.get(word)
+        if pairs is None:
+            results = []
+            for key in self.word_to_keys.get(word, []):
+                for result in self.db.get_entries(key):
+                    results.append(result)
+            results.sort()
+            pairs = [(key, value) for stamp, source, key, value in results]
+            self.cache[word] = pairs
+        for key, value in pairs:
             yield key, value
 
     def add(self, key, value):
@@ -268,12 +605,12 @@ class Database:
             self.open()
         self.db.add_entry(common.server.source, key, value)
         word = self.canonical_key(key)
-        keys = self.word_to_keys.get(word)
-        if keys is None:
-            keys = self.word_to_keys[word] = []
-        if key not in keys:
-            keys.append(key)
-            keys.sort()
+        if word not in self.word_to_keys:
+            self.trigrams.add(word)
+        self.word_to_keys.add(word, key)
+        self.cache.discard(word)
+        self.notify(word)
+        self.schedule_commit()
 
     def delete(self, key, which):
         # WHICH is either a True for all, None for the only entry, a number
@@ -308,98 +645,455 @@ class Database:
                 raise common.Error("%d is not valid index, %d is maximum"
                                    % (which[1], len(results) - 1))
             indices = range(which[0], which[1] + 1)
-        # Add "deleted" entries, so deletions leave a trace.
-        pairs = []
-        for index in indices:
-            stamp, source, key, value = results[index]
-            pairs.append(('', NUL.join([key, stamp, source, value])))
-        self.db.add_entries(common.server.source, pairs)
-        # Do the actual deletions, cleaning up WORD_TO_KEYS as we go.
-        for index in indices:
-            stamp, source, key, value = results[index]
-            if self.db.delete_entry(key, stamp):
-                keys.remove(key)
-                if not keys:
-                    del self.word_to_keys[word]
+        # Delete entries, leaving "deleted" entries as a trace, then clean
+        # up WORD_TO_KEYS for groups which vanished.
+        emptied = self.db.erase_entries(
+            common.server.source, [results[index] for index in indices])
+        for key in emptied:
+            self.word_to_keys.remove(word, key)
+            if word not in self.word_to_keys:
+                self.trigrams.remove(word)
+        self.cache.discard(word)
+        self.notify(word)
+        self.schedule_commit()
         # Return the number of deleted entries.
         return len(indices)
 
-    def open(self):
-        self.db = Unicode_database('w')
-        self.word_to_keys = {}
-        for key, value in self.db:
-            if NUL not in key:
-                word = self.canonical_key(key)
+    def compact(self, days):
+        if self.db is None:
+            self.open()
+        dropped, report = self.db.compact(days)
+        self.forget_groups(dropped)
+        return report
+
+    def compact_in_thread(self, days, callback, errback):
+        # Same as `compact', but the database gets copied by a worker thread
+        # using a handle of its own, so the bot goes on replying meanwhile.
+        # The copy is abandoned if the database changes in the meantime.
+        # CALLBACK later gets the report, or ERRBACK the exception info.
+        if self.compacting:
+            raise common.Error("compaction is already running")
+        if self.db is None:
+            self.open()
+        self.commit()
+        stamp = self.db.stamp()
+
+        def copy():
+            reader = Unicode_database('r')
+            try:
+                return reader.copy_compacted(days)
+            finally:
+                reader.close()
+
+        def replace(compaction):
+            self.compacting = False
+            try:
+                report = self.replace_compacted(compaction, stamp)
+            except common.Error:
+                errback(*sys.exc_info())
+            else:
+                callback(report)
+
+        def fail(*exc_info):
+            self.compacting = False
+            errback(*exc_info)
+
+        self.compacting = True
+        common.server.connection.execute_in_thread(copy, (), replace, fail)
+
+    def replace_compacted(self, compaction, stamp):
+        if self.db is None:
+            self.open()
+        self.commit()
+        if self.db.stamp() != stamp:
+            self.db.storage.discard(compaction[0])
+            raise common.Error("the database changed, compaction abandoned")
+        dropped, report = self.db.replace_compacted(compaction)
+        self.forget_groups(dropped)
+        return report
+
+    def forget_groups(self, dropped):
+        # Forget about the groups which vanished, then save the word index
+        # against the rewritten storage.
+        for key in dropped:
+            word = self.canonical_key(key)
+            if key in self.word_to_keys.get(word, ()):
+                self.word_to_keys.remove(word, key)
                 if word not in self.word_to_keys:
-                    self.word_to_keys[word] = []
-                self.word_to_keys[word].append(key)
-        if '' in self.word_to_keys:
-            del self.word_to_keys['']
+                    self.trigrams.remove(word)
+                self.cache.discard(word)
+                self.notify(word)
+        self.word_to_keys.save()
+
+    def add_word_listener(self, listener):
+        # LISTENER is told about canonical words as they appear, change or
+        # vanish.  It gets `add(WORD, KEY)', KEY being the first raw key for
+        # WORD, and `remove(WORD)'.  On open, it gets `reset(WORDS)', WORDS
+        # mapping each known word to its first key, which also happens
+        # right away.
+        if self.db is None:
+            self.open()
+        self.word_listeners.append(listener)
+        listener.reset(self.first_keys())
+
+    def first_keys(self):
+        first_keys = {}
+        for word, keys in self.word_to_keys.iteritems():
+            first_keys[word] = keys[0]
+        return first_keys
+
+    def notify(self, word):
+        keys = self.word_to_keys.get(word)
+        for listener in self.word_listeners:
+            if keys:
+                listener.add(word, keys[0])
+            else:
+                listener.remove(word)
+
+    def schedule_commit(self):
+        # Have pending changes synced soon, without delaying the reply.
+        if not self.commit_scheduled and common.server is not None:
+            common.server.connection.execute_delayed(self.commit_delay,
+                                                     self.commit)
+            self.commit_scheduled = True
+
+    def commit(self):
+        self.commit_scheduled = False
+        if self.db is not None:
+            self.db.commit()
+            # Syncing changed the database files, record how they now are.
+            self.word_to_keys.write_stamp()
+
+    def open(self):
+        self.db = Unicode_database('w', group_commit=True)
+        self.word_to_keys = Word_index(self.db.name, self.db.stamp)
+        if not self.word_to_keys.load():
+            # The saved index is missing or stale, rebuild it the long way.
+            self.word_to_keys.clear()
+            for key, value in self.db:
+                if NUL not in key:
+                    word = self.canonical_key(key)
+                    if word not in self.word_to_keys:
+                        self.word_to_keys[word] = []
+                    self.word_to_keys[word].append(key)
+            if '' in self.word_to_keys:
+                del self.word_to_keys['']
+            self.word_to_keys.save()
+        self.trigrams = Trigram_index(self.word_to_keys)
+        if self.word_listeners:
+            first_keys = self.first_keys()
+            for listener in self.word_listeners:
+                listener.reset(first_keys)
 
     def close(self):
         self.db.close()
         self.db = None
+        self.word_to_keys.save()
+        self.cache.clear()
+
+    def statistics(self):
+        return "Definition cache: " + self.cache.report()
 
     def canonical_key(self, key):
-        return key.replace(' ', '').replace('-', '').lower()
+        return canonical_key(key)
 
 database = Database()
+common.statistics.append(database.statistics)
+
+class Word_index(dict):
+    # Map each canonical word to the sorted list of raw keys it stands for.
+    # NAME is the database file name, STAMP a function returning a value
+    # which changes whenever that database file gets modified.
+    journal_limit = 1000
+
+    def __init__(self, name, stamp):
+        dict.__init__(self)
+        self.name = name + '.index'
+        self.stamp = stamp
+        self.journal = None
+        self.journal_size = 0
+
+    def add(self, word, key):
+        keys = self.get(word)
+        if keys is None:
+            keys = self[word] = []
+        if key not in keys:
+            keys.append(key)
+            keys.sort()
+        self.write_journal(word, key, True)
+
+    def remove(self, word, key):
+        keys = self.get(word)
+        if keys is not None and key in keys:
+            keys.remove(key)
+            if not keys:
+                del self[word]
+        self.write_journal(word, key, False)
+
+    def load(self):
+        # Return True if the saved index got loaded and is still current.
+        try:
+            snapshot = file(self.name, 'rb')
+        except IOError:
+            return False
+        try:
+            try:
+                stamp, word_to_keys = marshal.load(snapshot)
+            except (EOFError, ValueError, TypeError):
+                return False
+        finally:
+            snapshot.close()
+        self.clear()
+        self.update(word_to_keys)
+        # Replay changes made after the snapshot.  A truncated last record
+        # merely means the matching database update may be missing too, the
+        # stamp comparison below then forces a rebuild.
+        try:
+            journal = file(self.name + '-log', 'rb')
+        except IOError:
+            pass
+        else:
+            try:
+                while True:
+                    try:
+                        stamp, word, key, present = marshal.load(journal)
+                    except (EOFError, ValueError, TypeError):
+                        break
+                    self.journal_size += 1
+                    if word is None:
+                        # Only a fresh stamp, written after a commit.
+                        continue
+                    keys = self.get(word)
+                    if present:
+                        if keys is None:
+                            keys = self[word] = []
+                        if key not in keys:
+                            keys.append(key)
+                            keys.sort()
+                    elif keys is not None and key in keys:
+                        keys.remove(key)
+                        if not keys:
+                            del self[word]
+            finally:
+                journal.close()
+        return stamp == self.stamp()
+
+    def save(self):
+        # Write a fresh snapshot, making the journal useless.
+        self.close_journal()
+        snapshot = file(self.name + '-new', 'wb')
+        marshal.dump((self.stamp(), dict(self)), snapshot)
+        snapshot.close()
+        os.rename(self.name + '-new', self.name)
+        if os.path.exists(self.name + '-log'):
+            os.remove(self.name + '-log')
+        self.journal_size = 0
+
+    def write_journal(self, word, key, present):
+        # The stamp saved with each change is taken before the database
+        # gets synced, so it is usually stale.  `write_stamp' follows once
+        # the database is synced.  If the bot dies before that, the database
+        # journal gets replayed on restart, the stamp does not match, and
+        # the index gets rebuilt.
+        if self.journal_size >= self.journal_limit:
+            self.save()
+            return
+        if self.journal is None:
+            self.journal = file(self.name + '-log', 'ab')
+        marshal.dump((self.stamp(), word, key, present), self.journal)
+        self.journal.flush()
+        self.journal_size += 1
+
+    def write_stamp(self):
+        # Record the stamp of the database as just synced, which makes the
+        # saved index current again.
+        self.write_journal(None, None, None)
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+class Trigram_index(dict):
+    # Map each trigram to the set of canonical words containing it, so
+    # substring searches only look at words sharing all pattern trigrams.
+
+    def __init__(self, words=()):
+        dict.__init__(self)
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        for index in range(len(word) - 2):
+            trigram = word[index:index+3]
+            words = self.get(trigram)
+            if words is None:
+                words = self[trigram] = set()
+            words.add(word)
+
+    def remove(self, word):
+        for index in range(len(word) - 2):
+            trigram = word[index:index+3]
+            words = self.get(trigram)
+            if words is not None:
+                words.discard(word)
+                if not words:
+                    del self[trigram]
+
+    def candidates(self, pattern):
+        # Return a set of words which may contain PATTERN, or None if
+        # PATTERN is too short for trigrams to tell anything.  Each word
+        # in the set still has to be checked against PATTERN.
+        if len(pattern) < 3:
+            return None
+        postings = []
+        for index in range(len(pattern) - 2):
+            words = self.get(pattern[index:index+3])
+            if words is None:
+                return set()
+            postings.append(words)
+        postings.sort(key=len)
+        return postings[0].intersection(*postings[1:])
 
 class Unicode_database:
-    def __init__(self, mode):
-        self.db = bsddb.btopen('%s/db' % common.datadir, mode)
+    # In GROUP_COMMIT mode, `sync' only syncs the storage every COMMIT_SIZE
+    # changes, or when `commit' or `close' gets called.  The records of a
+    # logical change are rather gathered in memory, then journalled with a
+    # single flush by `sync', so the change survives a crash happening
+    # before the storage gets synced.
+    commit_size = 200
+
+    def __init__(self, mode, group_commit=False, backend=None):
+        self.name = '%s/db' % common.datadir
+        if backend is None:
+            backend = storage_backend
+        if backend is None:
+            if bsddb is None or os.path.exists(self.name + '.sqlite'):
+                backend = 'sqlite'
+            else:
+                backend = 'bsddb'
+        if backend == 'sqlite':
+            self.storage = Sqlite_storage(self.name + '.sqlite', mode)
+        else:
+            self.storage = Btree_storage(self.name, mode)
+        self.group_commit = group_commit
+        self.journal = None
+        self.records = []
+        self.pending = 0
+        if mode != 'r':
+            self.replay_journal()
 
     def __getattr__(self, attribute):
-        return getattr(self.db, attribute)
+        return getattr(self.storage, attribute)
 
     def __delitem__(self, key):
-        del self.db[key.encode(file_encoding)]
+        self.write_journal(key, None)
+        self.storage.remove(key)
 
     def __getitem__(self, key):
-        return self.db[key.encode(file_encoding)].decode(file_encoding)
+        return self.storage.get(key)
 
     def __setitem__(self, key, value):
-        self.db[key.encode(file_encoding)] = value.encode(file_encoding)
+        self.write_journal(key, value)
+        self.storage.put(key, value)
 
     def __iter__(self):
-        try:
-            key, value = self.first()
-            while True:
-                yield key, value
-                key, value = self.next()
-        except bsddb.error:
-            pass
+        return self.storage.items()
 
     def has_key(self, key):
-        return self.db.has_key(key.encode(file_encoding))
+        return self.storage.has_key(key)
 
-    def first(self):
-        key, value = self.db.first()
-        return key.decode(file_encoding), value.decode(file_encoding)
+    def write_journal(self, key, value):
+        # VALUE is None when KEY gets deleted.  The record is only written
+        # by the next `sync'.
+        if self.group_commit:
+            self.records.append((key, value))
 
-    def next(self):
-        key, value = self.db.next()
+    def flush_journal(self):
+        if not self.records:
+            return
+        if self.journal is None:
+            self.journal = file(self.name + '.journal', 'ab')
+        for record in self.records:
+            marshal.dump(record, self.journal)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.records = []
+
+    def replay_journal(self):
+        # Redo changes journalled by a process which died before syncing.
+        try:
+            journal = file(self.name + '.journal', 'rb')
+        except IOError:
+            return
+        replayed = False
         try:
-            return key.decode(file_encoding), value.decode(file_encoding)
-        except UnicodeDecodeError:
-            return key.decode('ISO-8859-1'), value.decode('ISO-8859-1')
+            while True:
+                try:
+                    key, value = marshal.load(journal)
+                except (EOFError, ValueError, TypeError):
+                    break
+                if value is None:
+                    if self.storage.has_key(key):
+                        self.storage.remove(key)
+                else:
+                    self.storage.put(key, value)
+                replayed = True
+        finally:
+            journal.close()
+        # Leave an untouched storage alone, so its stamp still matches.
+        if replayed:
+            self.storage.sync()
+        os.remove(self.name + '.journal')
+
+    def sync(self):
+        # Called after each logical change to the database.
+        if self.group_commit:
+            self.pending += 1
+            if self.pending < self.commit_size:
+                self.flush_journal()
+                return
+        self.commit()
+
+    def commit(self):
+        if self.group_commit and not self.pending and not self.records:
+            return
+        self.storage.sync()
+        self.pending = 0
+        # Synced changes need no journal anymore.
+        self.records = []
+        if self.journal is not None:
+            self.journal.truncate(0)
+
+    def close(self):
+        self.storage.close()
+        self.records = []
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+            os.remove(self.name + '.journal')
+
+    def stamp(self):
+        return self.storage.stamp()
 
     def get_entries(self, goal_key):
-        encoded_key = goal_key.encode(file_encoding)
-        self.db.set_location(encoded_key)
-        try:
-            full_key, full_value = self.next()
-            assert NUL in full_key, full_key
-            key, stamp = full_key.split(NUL)
-            while key == goal_key:
+        for full_key, full_value in self.storage.items(goal_key + NUL):
+            if NUL not in full_key:
+                break
+            key, stamp = full_key.split(NUL, 1)
+            if key != goal_key:
+                break
+            source, value = full_value.split(NUL, 1)
+            yield stamp, source, key, value
+
+    def search_entries(self, words):
+        # Produce (STAMP, SOURCE, KEY, VALUE) for entries having all WORDS
+        # within their value, deleted entries excepted.
+        for full_key, full_value in self.storage.search(words):
+            key, stamp = full_key.split(NUL, 1)
+            if key:
                 source, value = full_value.split(NUL, 1)
                 yield stamp, source, key, value
-                full_key, full_value = self.next()
-                if NUL not in full_key:
-                    break
-                key, stamp = full_key.split(NUL)
-        except bsddb.error:
-            pass
 
     def add_entries(self, source, pairs):
         if len(pairs) == 1:
@@ -407,77 +1101,603 @@ class Unicode_database:
         else:
             pairs.sort()
             previous_key = None
-            stamp = common.timestamp()
-            width = len(str(len(pairs)))
-            for counter, (key, value) in enumerate(pairs):
+            for key, value in pairs:
                 if key != previous_key:
-                    self.db[key] = ''
+                    self[key] = ''
                     previous_key = key
-                self[key + NUL + stamp + '%.*d' % (width, counter)] = (
+                self[key + NUL + common.unique_timestamp()] = (
                     source + NUL + value)
-            self.db.sync()
+            self.sync()
 
     def add_entry(self, source, key, value):
         self[key] = ''
-        self[key + NUL + common.timestamp()] = source + NUL + value
-        self.db.sync()
+        self[key + NUL + common.unique_timestamp()] = source + NUL + value
+        self.sync()
+
+    def entries_by_source(self, goal_source):
+        # Produce (STAMP, SOURCE, KEY, VALUE) for records from GOAL_SOURCE,
+        # including deletion records where GOAL_SOURCE is the deleter.
+        for full_key in self.storage.keys_by_source(goal_source):
+            key, stamp = full_key.split(NUL, 1)
+            source, value = self[full_key].split(NUL, 1)
+            yield stamp, source, key, value
+
+    def changes_since(self, goal_stamp):
+        # Produce (FULL_KEY, FULL_VALUE) for records stamped GOAL_STAMP or
+        # later, in stamp order.  Deletion records are included.
+        for full_key in self.storage.keys_since(goal_stamp):
+            yield full_key, self[full_key]
+
+    def changes_since_stamp(self, goal_stamp):
+        # Same, as (STAMP, SOURCE, KEY, VALUE) tuples.  KEY is empty for a
+        # deletion, then SOURCE is the deleter and VALUE describes what got
+        # deleted, as `KEY\0STAMP\0SOURCE\0VALUE'.
+        for full_key, full_value in self.changes_since(goal_stamp):
+            key, stamp = full_key.split(NUL, 1)
+            source, value = full_value.split(NUL, 1)
+            yield stamp, source, key, value
 
     def delete_entries(self, source_to_erase):
-        deletes = set()
-        current_key = None
+        # Return the list of erased (FULL_KEY, FULL_VALUE) pairs.
+        erased = []
+        for stamp, source, key, value in self.entries_by_source(
+                source_to_erase):
+            erased.append((key + NUL + stamp, source + NUL + value))
+        keys = set()
+        for full_key, full_value in erased:
+            del self[full_key]
+            keys.add(full_key.split(NUL, 1)[0])
+        # Also delete the KEY record of groups left without entries.
+        for key in keys:
+            for entry in self.get_entries(key):
+                break
+            else:
+                if self.has_key(key):
+                    del self[key]
+        if erased:
+            self.sync()
+        return erased
+
+    def compact(self, days):
+        # Archive deletion records older than DAYS into the history file,
+        # drop group records left without entries, and have the storage
+        # rewritten densely.  Return the list of dropped group keys, and a
+        # line reporting sizes and scan times.
+        self.commit()
+        return self.replace_compacted(self.copy_compacted(days))
+
+    def copy_compacted(self, days):
+        # Write a compacted copy of the storage beside it.  This only reads
+        # the database, so it may run in another thread, on a handle of its
+        # own.  Return what `replace_compacted' needs.
+        limit = common.timestamp(time.time() - days * 24 * 60 * 60)
+        size_before = self.storage.size()
+        start = time.time()
+        archived = []
+        dropped = []
+        group = None
         count = 0
-        for full_key, full_value in self:
+        for full_key, full_value in self.storage.items():
             if NUL in full_key:
-                key, stamp = full_key.split(NUL)
-                if key != current_key:
-                    if current_key is not None and count == 0:
-                        deletes.add(current_key)
-                    current_key = None
-                    count = 0
-                source, value = full_value.split(NUL, 1)
-                if source == source_to_erase:
-                    deletes.add(full_key)
-                else:
+                key, stamp = full_key.split(NUL, 1)
+                if not key and stamp < limit:
+                    archived.append((full_key, full_value))
+                elif key == group:
                     count += 1
             else:
-                if current_key is not None and count == 0:
-                    deletes.add(current_key)
-                current_key = key
+                if group is not None and not count:
+                    dropped.append(group)
+                group = full_key
                 count = 0
-        if current_key is not None and count == 0:
-            deletes.add(current_key)
-        if deletes:
-            for key in deletes:
-                del self[key]
-            self.db.sync()
+        if group is not None and not count:
+            dropped.append(group)
+        scan_before = time.time() - start
+        drop = set(dropped)
+        drop.update([key for key, value in archived])
+        name = self.storage.name + '-compact'
+        copy = self.storage.copy(drop, name)
+        try:
+            size_after = copy.size()
+            start = time.time()
+            for full_key, full_value in copy.items():
+                pass
+            scan_after = time.time() - start
+        finally:
+            copy.close()
+        report = ("%d deletions archived, %d empty groups dropped;"
+                  " %d -> %d bytes, scan %.2f -> %.2f seconds."
+                  % (len(archived), len(dropped), size_before, size_after,
+                     scan_before, scan_after))
+        return name, archived, dropped, report
+
+    def replace_compacted(self, compaction):
+        # Archive deletions, then have the compacted copy replace the
+        # storage.  Return the list of dropped group keys, and the report.
+        name, archived, dropped, report = compaction
+        if archived:
+            history = file(self.name + '.history', 'a')
+            for key, value in archived:
+                history.write(('%s\t%s\n' % (key, value)).encode(file_encoding))
+            history.flush()
+            os.fsync(history.fileno())
+            history.close()
+        self.storage.replace(name)
+        return dropped, report
 
-    def delete_entry(self, goal_key, goal_stamp):
-        encoded_key = goal_key.encode(file_encoding)
-        encoded_stamp = goal_stamp.encode(file_encoding)
-        self.db.set_location(encoded_key)
+    def erase_entries(self, source, entries):
+        # Delete ENTRIES, given as (STAMP, SOURCE, KEY, VALUE), leaving for
+        # each a deletion record from SOURCE.  The whole batch goes to the
+        # journal at once and costs a single sync.  Return the set of keys
+        # left without any entry.
+        self[''] = ''
+        for stamp, author, key, value in entries:
+            self[NUL + common.unique_timestamp()] = (
+                source + NUL + NUL.join([key, stamp, author, value]))
+        emptied = set()
+        for stamp, author, key, value in entries:
+            if self.delete_entry(key, stamp, False):
+                emptied.add(key)
+        self.sync()
+        return emptied
+
+    def delete_entry(self, goal_key, goal_stamp, sync=True):
         found = False
         counter = 0
-        try:
-            full_key, full_value = self.next()
-            assert NUL in full_key, full_key
-            key, stamp = full_key.split(NUL)
-            while key == goal_key:
-                if stamp == goal_stamp:
-                    found = True
-                else:
-                    counter += 1
-                full_key, full_value = self.next()
-                if NUL not in full_key:
-                    break
-                key, stamp = full_key.split(NUL)
-        except bsddb.error:
-            pass
+        for stamp, source, key, value in self.get_entries(goal_key):
+            if stamp == goal_stamp:
+                found = True
+            else:
+                counter += 1
         if found:
-            del self.db[encoded_key + NUL + encoded_stamp]
+            del self[goal_key + NUL + goal_stamp]
         # Return True only when the last entry is being deleted.
         if counter:
-            self.db.sync()
+            if sync:
+                self.sync()
             return False
+        del self[goal_key]
+        if sync:
+            self.sync()
+        return True
+
+## Storage backends.
+
+# A storage holds Unicode keys and values.  `items' iterates over (KEY,
+# VALUE) pairs in the order of UTF-8 encoded keys, starting at the first key
+# not smaller than START.  `sync' makes all changes durable.  `stamp'
+# returns something which changes whenever the storage contents change, and
+# which remains available after `close'.  `search' yields the (KEY, VALUE)
+# pairs having all given words within VALUE.  `keys_by_source' yields the
+# `KEY\0STAMP' keys of records having a given SOURCE, and `keys_since' the
+# `KEY\0STAMP' keys having STAMP not smaller than a given stamp, in stamp
+# order.  `copy' writes a dense copy of the storage without a set of keys
+# under another name, returning that copy opened, which `replace' then
+# moves over the storage, and `discard' removes storage files by name.
+# `size' tells how many bytes the storage uses on disk.
+
+# Storage to use, either 'bsddb' or 'sqlite'.  If None, SQLite is used when
+# its database file exists or when Berkeley DB is not available.
+storage_backend = None
+
+class Btree_storage:
+
+    def __init__(self, name, mode):
+        self.name = name
+        self.mode = mode
+        self.db = bsddb.btopen(name, mode)
+        self.open_indexes(mode)
+
+    def open_indexes(self, mode):
+        self.by_source = Btree_index(self.name + '.by-source', mode,
+                                     source_index_key, self)
+        self.by_stamp = Btree_index(self.name + '.by-stamp', mode,
+                                    stamp_index_key, self)
+        self.indexes = self.by_source, self.by_stamp
+
+    def get(self, key):
+        return decode(self.db[key.encode(file_encoding)])
+
+    def put(self, key, value):
+        encoded_key = key.encode(file_encoding)
+        if self.db.has_key(encoded_key):
+            previous = decode(self.db[encoded_key])
+        else:
+            previous = None
+        self.db[encoded_key] = value.encode(file_encoding)
+        for index in self.indexes:
+            if previous is not None:
+                index.remove(key, previous)
+            index.add(key, value)
+
+    def remove(self, key):
+        encoded_key = key.encode(file_encoding)
+        previous = decode(self.db[encoded_key])
         del self.db[encoded_key]
+        for index in self.indexes:
+            index.remove(key, previous)
+
+    def has_key(self, key):
+        return self.db.has_key(key.encode(file_encoding))
+
+    def items(self, start=u''):
+        try:
+            if not start:
+                key, value = self.db.first()
+            else:
+                key, value = self.db.set_location(start.encode(file_encoding))
+            while True:
+                yield decode(key), decode(value)
+                key, value = self.db.next()
+        except bsddb.error:
+            pass
+
+    def search(self, words):
+        words = [word.lower() for word in words]
+        for key, value in self.items():
+            lowered = value.lower()
+            for word in words:
+                if word not in lowered:
+                    break
+            else:
+                yield key, value
+
+    def keys_by_source(self, source):
+        if self.by_source.db is None:
+            for key, value in self.items():
+                if source_index_key(key, value) is not None:
+                    if value.split(NUL, 1)[0] == source:
+                        yield key
+        else:
+            prefix = source + NUL
+            for index_key in self.by_source.items(prefix, prefix):
+                yield index_key[len(prefix):]
+
+    def keys_since(self, stamp):
+        if self.by_stamp.db is None:
+            pairs = []
+            for key, value in self.items():
+                index_key = stamp_index_key(key, value)
+                if index_key is not None and index_key >= stamp:
+                    pairs.append(index_key.split(NUL, 1))
+            pairs.sort()
+            for stamp, key in pairs:
+                yield key
+        else:
+            for index_key in self.by_stamp.items(stamp):
+                yield index_key.split(NUL, 1)[1]
+
+    suffixes = '', '.by-source', '.by-stamp'
+
+    def copy(self, drop, name):
+        # Copy kept records in order into a fresh B-tree, then index it.
+        self.discard(name)
+        drop = set([key.encode(file_encoding) for key in drop])
+        new = bsddb.btopen(name, 'n')
+        try:
+            key, value = self.db.first()
+            while True:
+                if key not in drop:
+                    new[key] = value
+                key, value = self.db.next()
+        except bsddb.error:
+            pass
+        new.close()
+        return Btree_storage(name, 'w')
+
+    def replace(self, name):
+        # Renaming keeps the stamp, so the copied indexes remain valid.
+        self.close()
+        for suffix in self.suffixes:
+            os.rename(name + suffix, self.name + suffix)
+        self.db = bsddb.btopen(self.name, 'w')
+        self.open_indexes('w')
+
+    def discard(self, name):
+        for suffix in self.suffixes:
+            if os.path.exists(name + suffix):
+                os.remove(name + suffix)
+
+    def size(self):
+        size = 0
+        for suffix in self.suffixes:
+            if os.path.exists(self.name + suffix):
+                size += os.path.getsize(self.name + suffix)
+        return size
+
+    def sync(self):
+        if self.mode == 'r':
+            return
         self.db.sync()
-        return True
+        stamp = self.stamp()
+        for index in self.indexes:
+            index.sync(stamp)
+
+    def close(self):
+        self.sync()
+        self.db.close()
+        for index in self.indexes:
+            index.close()
+
+    def stamp(self):
+        # Describe the database file well enough to notice later changes.
+        try:
+            info = os.stat(self.name)
+        except OSError:
+            return None
+        return info.st_size, info.st_mtime
+
+class Btree_index:
+    # Secondary B-tree having an empty value for each key produced by
+    # FUNCTION out of a record of the main STORAGE.  FUNCTION returns None
+    # for records not to be indexed.  The '' key holds the main stamp as of
+    # the last sync: if the main B-tree got changed behind our back, the
+    # index gets rebuilt, or merely ignored when opened read-only.
+
+    def __init__(self, name, mode, function, storage):
+        self.function = function
+        self.db = None
+        if mode == 'r':
+            if os.path.exists(name):
+                self.db = bsddb.btopen(name, 'r')
+                if self.db.get('') != repr(storage.stamp()):
+                    self.db.close()
+                    self.db = None
+            return
+        if mode == 'n':
+            self.db = bsddb.btopen(name, 'n')
+        else:
+            self.db = bsddb.btopen(name, 'c')
+            if self.db.get('') == repr(storage.stamp()):
+                return
+            self.db.clear()
+        for key, value in storage.items():
+            self.add(key, value)
+        self.sync(storage.stamp())
+
+    def add(self, key, value):
+        index_key = self.function(key, value)
+        if index_key is not None:
+            self.db[index_key.encode(file_encoding)] = ''
+
+    def remove(self, key, value):
+        index_key = self.function(key, value)
+        if index_key is not None:
+            encoded_key = index_key.encode(file_encoding)
+            if self.db.has_key(encoded_key):
+                del self.db[encoded_key]
+
+    def items(self, start, prefix=u''):
+        # Produce index keys from START on, in order, while they start
+        # with PREFIX.
+        encoded_prefix = prefix.encode(file_encoding)
+        try:
+            key, value = self.db.set_location(start.encode(file_encoding))
+            while key.startswith(encoded_prefix):
+                if key:
+                    yield decode(key)
+                key, value = self.db.next()
+        except bsddb.error:
+            pass
+
+    def sync(self, stamp):
+        if self.db is not None:
+            self.db[''] = repr(stamp)
+            self.db.sync()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+def source_index_key(key, value):
+    if NUL in key and NUL in value:
+        return value.split(NUL, 1)[0] + NUL + key
+
+def stamp_index_key(key, value):
+    if NUL in key:
+        return key.split(NUL, 1)[1] + NUL + key
+
+class Sqlite_storage:
+    # A `KEY\0STAMP' key with a `SOURCE\0VALUE' value is held in a row with
+    # KEY, STAMP, SOURCE and VALUE columns, WORD being the canonical KEY.  A
+    # key without NUL gets an empty STAMP, and a value without NUL gets a
+    # NULL SOURCE.  Paging through `items' relies on row values, which need
+    # SQLite 3.15 or later.
+    page_size = 500
+
+    schema = """\
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT NOT NULL,
+    stamp TEXT NOT NULL,
+    source TEXT,
+    value TEXT NOT NULL,
+    word TEXT NOT NULL,
+    PRIMARY KEY (key, stamp));
+CREATE INDEX IF NOT EXISTS entries_word ON entries (word);
+CREATE INDEX IF NOT EXISTS entries_source ON entries (source);
+CREATE INDEX IF NOT EXISTS entries_stamp ON entries (stamp);
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_search USING fts4 (value);
+CREATE TABLE IF NOT EXISTS generation (counter INTEGER NOT NULL);
+INSERT INTO generation SELECT 0 WHERE NOT EXISTS (SELECT * FROM generation);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE generation SET counter = counter + 1;
+    INSERT INTO entries_search (docid, value)
+        SELECT new.rowid, new.value WHERE new.stamp != '';
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE generation SET counter = counter + 1;
+    DELETE FROM entries_search WHERE docid = old.rowid;
+END;
+"""
+
+    def __init__(self, name, mode):
+        self.name = name
+        if mode == 'n':
+            self.discard(name)
+        elif mode in ('r', 'w') and not os.path.exists(name):
+            raise common.Error("%s does not exist" % name)
+        self.connect(mode)
+
+    def connect(self, mode):
+        import sqlite3
+        self.connection = sqlite3.connect(self.name)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        if mode != 'r':
+            self.connection.executescript(self.schema)
+        self.last_stamp = None
+
+    def get(self, key):
+        key, stamp = split_key(key)
+        row = self.connection.execute(
+            'SELECT source, value FROM entries WHERE key = ? AND stamp = ?',
+            (key, stamp)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return join_value(*row)
+
+    def put(self, key, value):
+        key, stamp = split_key(key)
+        if NUL in value:
+            source, value = value.split(NUL, 1)
+        else:
+            source = None
+        # Replace explicitly, as INSERT OR REPLACE would bypass triggers.
+        self.connection.execute(
+            'DELETE FROM entries WHERE key = ? AND stamp = ?', (key, stamp))
+        self.connection.execute(
+            'INSERT INTO entries (key, stamp, source, value, word)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            (key, stamp, source, value, canonical_key(key)))
+
+    def remove(self, key):
+        key, stamp = split_key(key)
+        cursor = self.connection.execute(
+            'DELETE FROM entries WHERE key = ? AND stamp = ?', (key, stamp))
+        if not cursor.rowcount:
+            raise KeyError(key)
+
+    def has_key(self, key):
+        key, stamp = split_key(key)
+        return self.connection.execute(
+            'SELECT 1 FROM entries WHERE key = ? AND stamp = ?',
+            (key, stamp)).fetchone() is not None
+
+    def items(self, start=u''):
+        # Fetch a page at a time, so no cursor stays open between calls.
+        key, stamp = split_key(start)
+        if start.endswith(NUL):
+            # Such a START sorts right after the KEY record itself.
+            comparison = '>'
+        else:
+            comparison = '>='
+        while True:
+            rows = self.connection.execute(
+                'SELECT key, stamp, source, value FROM entries'
+                ' WHERE (key, stamp) %s (?, ?) ORDER BY key, stamp LIMIT %d'
+                % (comparison, self.page_size), (key, stamp)).fetchall()
+            for key, stamp, source, value in rows:
+                yield join_key(key, stamp), join_value(source, value)
+            if len(rows) < self.page_size:
+                break
+            comparison = '>'
+
+    def keys_by_source(self, source):
+        rows = self.connection.execute(
+            'SELECT key, stamp FROM entries WHERE source = ? AND stamp != ?'
+            ' ORDER BY key, stamp', (source, u''))
+        for key, stamp in rows.fetchall():
+            yield join_key(key, stamp)
+
+    def keys_since(self, stamp):
+        rows = self.connection.execute(
+            'SELECT key, stamp FROM entries WHERE stamp >= ?'
+            ' ORDER BY stamp, key', (stamp,))
+        for key, stamp in rows.fetchall():
+            yield join_key(key, stamp)
+
+    def search(self, words):
+        query = ' '.join(['"%s"' % word.replace('"', '') for word in words])
+        rows = self.connection.execute(
+            'SELECT key, stamp, source, value FROM entries'
+            ' WHERE rowid IN (SELECT docid FROM entries_search'
+            ' WHERE value MATCH ?) ORDER BY key, stamp', (query,))
+        for key, stamp, source, value in rows.fetchall():
+            yield join_key(key, stamp), join_value(source, value)
+
+    suffixes = '', '-wal', '-shm'
+
+    def copy(self, drop, name):
+        # Snapshot the database into a new file, then compact the copy.
+        self.discard(name)
+        self.connection.execute('VACUUM INTO ?', (name,))
+        new = Sqlite_storage(name, 'w')
+        new.connection.executemany(
+            'DELETE FROM entries WHERE key = ? AND stamp = ?',
+            [split_key(key) for key in drop])
+        new.connection.execute(
+            "INSERT INTO entries_search (entries_search) VALUES ('optimize')")
+        new.connection.commit()
+        new.connection.execute('VACUUM')
+        new.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return new
+
+    def replace(self, name):
+        self.close()
+        self.discard(self.name)
+        os.rename(name, self.name)
+        self.connect('w')
+
+    def discard(self, name):
+        for suffix in self.suffixes:
+            if os.path.exists(name + suffix):
+                os.remove(name + suffix)
+
+    def size(self):
+        size = 0
+        for suffix in self.suffixes[:2]:
+            if os.path.exists(self.name + suffix):
+                size += os.path.getsize(self.name + suffix)
+        return size
+
+    def sync(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.last_stamp = self.stamp()
+        self.connection.close()
+        self.connection = None
+
+    def stamp(self):
+        if self.connection is None:
+            return self.last_stamp
+        row = self.connection.execute(
+            'SELECT counter FROM generation').fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+def split_key(full_key):
+    if NUL in full_key:
+        return full_key.split(NUL, 1)
+    return full_key, u''
+
+def join_key(key, stamp):
+    if stamp:
+        return key + NUL + stamp
+    return key
+
+def join_value(source, value):
+    if source is None:
+        return value
+    return source + NUL + value
+
+def decode(text):
+    try:
+        return text.decode(file_encoding)
+    except UnicodeDecodeError:
+        return text.decode('ISO-8859-1')
+
+def canonical_key(key):
+    return key.replace(' ', '').replace('-', '').lower()
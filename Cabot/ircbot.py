@@ -69,6 +69,7 @@ class SingleServerIRCBot(SimpleIRCClient):
         if not reconnection_interval or reconnection_interval < 0:
             reconnection_interval = 2**31
         self.reconnection_interval = reconnection_interval
+        self._checker = None
 
         self._nickname = nickname
         self._realname = realname
@@ -79,11 +80,19 @@ class SingleServerIRCBot(SimpleIRCClient):
                                                -10)
     def _connected_checker(self):
         """[Internal]"""
+        self._checker = None
         if not self.connection.is_connected():
-            self.connection.execute_delayed(self.reconnection_interval,
-                                            self._connected_checker)
+            self._schedule_checker()
             self.jump_server()
 
+    def _schedule_checker(self):
+        """[Internal]"""
+        # Keep a single checker pending, however many disconnections.
+        if self._checker is not None:
+            self._checker.cancel()
+        self._checker = self.connection.execute_delayed(
+            self.reconnection_interval, self._connected_checker)
+
     def _connect(self):
         """[Internal]"""
         password = None
@@ -101,8 +110,7 @@ class SingleServerIRCBot(SimpleIRCClient):
     def _on_disconnect(self, c, e):
         """[Internal]"""
         self.channels = IRCDict()
-        self.connection.execute_delayed(self.reconnection_interval,
-                                        self._connected_checker)
+        self._schedule_checker()
 
     def _on_join(self, c, e):
         """[Internal]"""
@@ -39,8 +39,8 @@ The main features of the IRC client framework are:
   * Messages from an IRC server triggers events, which can be caught
     by event handlers.
   * Reading from and writing to IRC server sockets are normally done
-    by an internal select() loop, but the select()ing may be done by
-    an external main loop.
+    by an internal epoll(), poll() or select() loop, but the polling
+    may be done by an external main loop.
   * Functions can be registered to execute at specified times by the
     event-loop.
   * Decodes CTCP tagging correctly (hopefully); I haven't seen any
@@ -66,11 +66,18 @@ please contact me (Joel Rosdahl <joel@rosdahl.net>).
 """
 
 import bisect
+import collections
+import fcntl
+import heapq
+import math
+import os
+import Queue
 import re
 import select
 import socket
 import string
 import sys
+import threading
 import time
 import types
 
@@ -79,7 +86,7 @@ DEBUG = 0
 
 # TODO
 # ----
-# (maybe) thread safety
+# (maybe) thread safety, besides execute_in_thread
 # (maybe) color parser convenience functions
 # documentation (including all event types)
 # (maybe) add awareness of different types of ircds
@@ -110,7 +117,8 @@ class IRC:
 
     The methods of most interest for an IRC client writer are server,
     add_global_handler, remove_global_handler, execute_at,
-    execute_delayed, process_once and process_forever.
+    execute_delayed, execute_every, execute_in_thread, process_once
+    and process_forever.
 
     Here is an example:
 
@@ -160,8 +168,16 @@ class IRC:
 
         self.fn_to_add_timeout = fn_to_add_timeout
         self.connections = []
+        self.poller = Poller()
         self.handlers = {}
-        self.delayed_commands = [] # list of tuples in the format (time, function, arguments)
+        # Heap of (time, sequence, DelayedCommand) tuples.  Cancelled
+        # commands stay until they surface, or until they are too many.
+        self.delayed_commands = []
+        self.delayed_sequence = 0
+        self.delayed_cancelled = 0
+        self.delayed_executed = 0
+        self.delayed_peak = 0
+        self.executor = None
 
         self.add_global_handler("ping", _ping_ponger, -42)
 
@@ -181,10 +197,11 @@ class IRC:
 
         See documentation for IRC.__init__.
         """
-        for s in sockets:
-            for c in self.connections:
-                if s == c._get_socket():
-                    c.process_data()
+        for c in map(self.poller.connections.get,
+                     [s.fileno() for s in sockets]):
+            # A previous connection may have closed this one meanwhile.
+            if c is not None and c._get_socket() is not None:
+                c.process_data()
 
     def process_timeout(self):
         """Called when a timeout notification is due.
@@ -192,45 +209,84 @@ class IRC:
         See documentation for IRC.__init__.
         """
         t = time.time()
-        while self.delayed_commands:
-            if t >= self.delayed_commands[0][0]:
-                apply(self.delayed_commands[0][1], self.delayed_commands[0][2])
-                del self.delayed_commands[0]
+        while self.delayed_commands and t >= self.delayed_commands[0][0]:
+            command = heapq.heappop(self.delayed_commands)[2]
+            if command.cancelled:
+                self.delayed_cancelled -= 1
+                continue
+            if command.period is None:
+                command.cancelled = 1
             else:
-                break
+                # Do not try catching up with missed periods.
+                command.at = max(command.at + command.period, t)
+                self._schedule(command)
+            self.delayed_executed += 1
+            apply(command.function, command.arguments)
 
     def process_once(self, timeout=0):
         """Process data from connections once.
 
         Arguments:
 
-            timeout -- How long the select() call should wait if no
-                       data is available.
+            timeout -- How long the poll should wait if no data is
+                       available, or None to wait until some data
+                       comes.
 
         This method should be called periodically to check and process
         incoming data, if there are any.  If that seems boring, look
         at the process_forever method.
         """
-        sockets = map(lambda x: x._get_socket(), self.connections)
-        sockets = filter(lambda x: x != None, sockets)
-        if sockets:
-            (i, o, e) = select.select(sockets, [], [], timeout)
-            self.process_data(i)
-        else:
-            time.sleep(timeout)
+        for c in self.poller.poll(timeout):
+            # A previous connection may have closed this one meanwhile.
+            if c._get_socket() is not None:
+                c.process_data()
         self.process_timeout()
 
-    def process_forever(self, timeout=0.2):
+    def process_forever(self, timeout=None):
         """Run an infinite loop, processing data from connections.
 
-        This method repeatedly calls process_once.
+        This method repeatedly calls process_once, waiting until the
+        next delayed command is due, so an idle loop does not wake up
+        needlessly, and delayed commands run on time.
 
         Arguments:
 
-            timeout -- Parameter to pass to process_once.
+            timeout -- Longest wait between calls, or None (the
+                       default) for no limit.
         """
         while 1:
-            self.process_once(timeout)
+            self.process_once(self.next_timeout(timeout))
+
+    def next_timeout(self, timeout=None):
+        """Return how long to wait for data before some command is due.
+
+        Arguments:
+
+            timeout -- Longest wait to return, or None for no limit.
+
+        The result is None if there is no limit and no delayed command.
+        """
+        while self.delayed_commands and self.delayed_commands[0][2].cancelled:
+            heapq.heappop(self.delayed_commands)
+            self.delayed_cancelled -= 1
+        if self.delayed_commands:
+            delay = max(self.delayed_commands[0][0] - time.time(), 0)
+            if timeout is None or delay < timeout:
+                return delay
+        return timeout
+
+    def delayed_statistics(self):
+        """Return statistics about delayed commands.
+
+        The result is a dictionary giving the number of commands
+        \"pending\", the number of \"cancelled\" ones still queued,
+        the number of commands \"executed\" so far, and the \"peak\"
+        queue depth.
+        """
+        return {"pending": len(self.delayed_commands) - self.delayed_cancelled,
+                "cancelled": self.delayed_cancelled,
+                "executed": self.delayed_executed,
+                "peak": self.delayed_peak}
 
     def disconnect_all(self, message=""):
         """Disconnects all connections."""
@@ -292,8 +348,10 @@ class IRC:
             function -- Function to call.
 
             arguments -- Arguments to give the function.
+
+        Returns a DelayedCommand object, which may be cancelled.
         """
-        self.execute_delayed(at-time.time(), function, arguments)
+        return self.execute_delayed(at-time.time(), function, arguments)
 
     def execute_delayed(self, delay, function, arguments=()):
         """Execute a function after a specified time.
@@ -305,10 +363,77 @@ class IRC:
             function -- Function to call.
 
             arguments -- Arguments to give the function.
+
+        Returns a DelayedCommand object, which may be cancelled.
         """
-        bisect.insort(self.delayed_commands, (delay+time.time(), function, arguments))
+        command = DelayedCommand(self, delay+time.time(), function, arguments)
+        self._schedule(command)
         if self.fn_to_add_timeout:
             self.fn_to_add_timeout(delay)
+        return command
+
+    def execute_every(self, period, function, arguments=()):
+        """Execute a function periodically.
+
+        Arguments:
+
+            period -- How many seconds between executions, the first
+                      one being after that many seconds too.
+
+            function -- Function to call.
+
+            arguments -- Arguments to give the function.
+
+        Returns a DelayedCommand object, which may be cancelled.
+        """
+        command = DelayedCommand(self, period+time.time(), function,
+                                 arguments, period)
+        self._schedule(command)
+        if self.fn_to_add_timeout:
+            self.fn_to_add_timeout(period)
+        return command
+
+    def execute_in_thread(self, function, arguments=(), callback=None,
+                          errback=None):
+        """Execute a function in a worker thread.
+
+        Arguments:
+
+            function -- Function to call.
+
+            arguments -- Arguments to give the function.
+
+            callback -- Function then called with the result, or None.
+
+            errback -- Function called with the exception type, value
+                       and traceback if the call raised, or None to
+                       raise the exception again.
+
+        The callback or errback is called from process_once, in the
+        thread processing connections, so it may safely send data.
+        Meanwhile, incoming data and delayed commands go on being
+        processed.
+        """
+        if self.executor is None:
+            self.executor = Executor(self)
+        self.executor.submit(function, arguments, callback, errback)
+
+    def _schedule(self, command):
+        """[Internal]"""
+        self.delayed_sequence += 1
+        heapq.heappush(self.delayed_commands,
+                       (command.at, self.delayed_sequence, command))
+        self.delayed_peak = max(self.delayed_peak, len(self.delayed_commands))
+
+    def _cancelled(self):
+        """[Internal]"""
+        self.delayed_cancelled += 1
+        if self.delayed_cancelled > len(self.delayed_commands) // 2:
+            # Too much garbage, rebuild the heap without it.
+            self.delayed_commands = [entry for entry in self.delayed_commands
+                                     if not entry[2].cancelled]
+            heapq.heapify(self.delayed_commands)
+            self.delayed_cancelled = 0
 
     def dcc(self, dcctype="chat"):
         """Creates and returns a DCCConnection object.
@@ -334,10 +459,230 @@ class IRC:
     def _remove_connection(self, connection):
         """[Internal]"""
         self.connections.remove(connection)
+        s = connection._get_socket()
+        if s is not None:
+            self._unregister_socket(s)
         if self.fn_to_remove_socket:
-            self.fn_to_remove_socket(connection._get_socket())
+            self.fn_to_remove_socket(s)
+
+    def _register_socket(self, s, connection):
+        """[Internal]"""
+        self.poller.register(s.fileno(), connection)
+
+    def _unregister_socket(self, s):
+        """[Internal]"""
+        try:
+            fd = s.fileno()
+        except socket.error:
+            # Already closed, so the kernel forgot it already.
+            self.poller.forget(s)
+        else:
+            self.poller.unregister(fd)
+
+
+class DelayedCommand:
+    """A function call scheduled by an IRC object.
+
+    DelayedCommand objects are returned by the execute_at,
+    execute_delayed and execute_every methods.  The at attribute
+    holds when the call is due, and period is the number of seconds
+    between periodic calls, or None.
+    """
+
+    def __init__(self, irclibobj, at, function, arguments, period=None):
+        self.irclibobj = irclibobj
+        self.at = at
+        self.function = function
+        self.arguments = arguments
+        self.period = period
+        self.cancelled = 0
+
+    def cancel(self):
+        """Prevent any further call.
+
+        Returns 1 if the command was pending, otherwise 0.
+        """
+        if self.cancelled:
+            return 0
+        self.cancelled = 1
+        self.irclibobj._cancelled()
+        return 1
+
 
-_rfc_1459_command_regexp = re.compile("^(:(?P<prefix>[^ ]+) +)?(?P<command>[^ ]+)( *(?P<argument> .+))?")
+class Executor:
+    """Runs functions in worker threads for an IRC object.
+
+    Results are queued for the thread running the IRC object, which
+    gets woken up through a pipe watched along with the connection
+    sockets.  Worker threads are started as needed, up to workers.
+    """
+
+    workers = 4
+
+    def __init__(self, irclibobj):
+        self.irclibobj = irclibobj
+        self.jobs = Queue.Queue()
+        self.results = collections.deque()
+        self.threads = []
+        self.idle = 0
+        self.lock = threading.Lock()
+        self.reading, self.writing = os.pipe()
+        for fd in self.reading, self.writing:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        irclibobj.poller.register(self.reading, self)
+
+    def submit(self, function, arguments, callback, errback):
+        """Queue function for a worker thread."""
+        self.lock.acquire()
+        try:
+            start = not self.idle and len(self.threads) < self.workers
+            if start:
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(1)
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+        if start:
+            thread.start()
+        self.jobs.put((function, arguments, callback, errback))
+
+    def _work(self):
+        """[Internal]"""
+        while 1:
+            self.lock.acquire()
+            self.idle += 1
+            self.lock.release()
+            function, arguments, callback, errback = self.jobs.get()
+            self.lock.acquire()
+            self.idle -= 1
+            self.lock.release()
+            try:
+                result = callback, (apply(function, arguments),)
+            except:
+                result = errback or _reraise, sys.exc_info()
+            self.results.append(result)
+            try:
+                os.write(self.writing, "!")
+            except OSError:
+                # The pipe is full, so a wake up is pending anyway.
+                pass
+
+    def _get_socket(self):
+        """[Internal]"""
+        return self.reading
+
+    def process_data(self):
+        """[Internal]"""
+        try:
+            os.read(self.reading, 4096)
+        except OSError:
+            pass
+        while self.results:
+            function, arguments = self.results.popleft()
+            if function is not None:
+                apply(function, arguments)
+
+
+class Poller:
+    """Watches connection sockets for incoming data.
+
+    The poller keeps a registry mapping each socket file descriptor
+    to its connection, updated as sockets are opened and closed, so
+    nothing is rebuilt or scanned on each loop iteration.  It uses
+    epoll when available (Linux), otherwise poll, otherwise select.
+    """
+
+    # Seconds to sleep at once, when there is nothing to wait for.
+    idle_timeout = 60
+
+    def __init__(self, backend=None):
+        """Constructor for Poller objects.
+
+        Arguments:
+
+            backend -- "epoll", "poll" or "select".  The default
+                       is the first available.
+        """
+        if backend is None:
+            for backend in "epoll", "poll", "select":
+                if hasattr(select, backend):
+                    break
+        self.backend = backend
+        self.connections = {}
+        self.fds = {}
+        if backend == "epoll":
+            self.watcher = select.epoll()
+        elif backend == "poll":
+            self.watcher = select.poll()
+        else:
+            self.watcher = None
+
+    def register(self, fd, connection):
+        """Watch file descriptor fd, which belongs to connection."""
+        if fd in self.connections:
+            # The descriptor got reused without being unregistered.
+            self.unregister(fd)
+        if connection in self.fds:
+            # The connection replaced its socket.
+            self.unregister(self.fds[connection])
+        self.connections[fd] = connection
+        self.fds[connection] = fd
+        if self.backend == "epoll":
+            self.watcher.register(fd, select.EPOLLIN | select.EPOLLPRI)
+        elif self.backend == "poll":
+            self.watcher.register(fd, select.POLLIN | select.POLLPRI)
+
+    def unregister(self, fd):
+        """Stop watching file descriptor fd."""
+        connection = self.connections.pop(fd, None)
+        if connection is not None:
+            del self.fds[connection]
+            if self.watcher is not None:
+                try:
+                    self.watcher.unregister(fd)
+                except (IOError, OSError, KeyError):
+                    pass
+
+    def forget(self, s):
+        """Stop watching socket s, once closed."""
+        for fd, connection in self.connections.items():
+            if connection._get_socket() is s:
+                self.unregister(fd)
+
+    def poll(self, timeout=None):
+        """Return connections having data, waiting at most timeout.
+
+        A timeout of None waits until some data comes.
+        """
+        if not self.connections:
+            # Nothing may happen, unless another thread intervenes.
+            if timeout is None:
+                timeout = self.idle_timeout
+            time.sleep(timeout)
+            return []
+        if self.backend == "epoll":
+            if timeout is None:
+                timeout = -1
+            elif timeout > 0:
+                # Round up to whole milliseconds, lest epoll truncates
+                # and wakes up just before a delayed command is due.
+                timeout = (math.ceil(timeout * 1000) + 0.5) / 1000
+            events = self.watcher.poll(timeout)
+        elif self.backend == "poll":
+            if timeout is not None:
+                timeout = int(math.ceil(timeout * 1000))
+            events = self.watcher.poll(timeout)
+        else:
+            events = [(fd, None)
+                      for fd in select.select(self.connections.keys(),
+                                              [], [], timeout)[0]]
+        connections = []
+        for fd, event in events:
+            connection = self.connections.get(fd)
+            if connection is not None:
+                connections.append(connection)
+        return connections
 
 
 class Connection:
@@ -355,10 +700,18 @@ class Connection:
     ### Convenience wrappers.
 
     def execute_at(self, at, function, arguments=()):
-        self.irclibobj.execute_at(at, function, arguments)
+        return self.irclibobj.execute_at(at, function, arguments)
 
     def execute_delayed(self, delay, function, arguments=()):
-        self.irclibobj.execute_delayed(delay, function, arguments)
+        return self.irclibobj.execute_delayed(delay, function, arguments)
+
+    def execute_every(self, period, function, arguments=()):
+        return self.irclibobj.execute_every(period, function, arguments)
+
+    def execute_in_thread(self, function, arguments=(), callback=None,
+                          errback=None):
+        self.irclibobj.execute_in_thread(function, arguments, callback,
+                                         errback)
 
 
 class ServerConnectionError(IRCError):
@@ -433,6 +786,7 @@ class ServerConnection(Connection):
         except socket.error, x:
             raise ServerConnectionError, "Couldn't connect to socket: %s" % x
         self.connected = 1
+        self.irclibobj._register_socket(self.socket, self)
         if self.irclibobj.fn_to_add_socket:
             self.irclibobj.fn_to_add_socket(self.socket)
 
@@ -505,41 +859,33 @@ class ServerConnection(Connection):
             if not line:
                 continue
 
+            if self._wants("all_raw_messages"):
+                self._handle_event(Event("all_raw_messages",
+                                         self.get_server_name(),
+                                         None,
+                                         [line]))
+
+            # Split the line by hand, as RFC 1459 says:
+            # [:PREFIX] COMMAND [ARGUMENT]... [:TRAILING ARGUMENT]
             prefix = None
-            command = None
-            arguments = None
-            self._handle_event(Event("all_raw_messages",
-                                     self.get_server_name(),
-                                     None,
-                                     [line]))
-
-            m = _rfc_1459_command_regexp.match(line)
-            if m.group("prefix"):
-                prefix = m.group("prefix")
-                if not self.real_server_name:
-                    self.real_server_name = prefix
-
-            if m.group("command"):
-                command = string.lower(m.group("command"))
-
-            if m.group("argument"):
-                a = string.split(m.group("argument"), " :", 1)
-                arguments = string.split(a[0])
-                if len(a) == 2:
-                    arguments.append(a[1])
-
-            if command == "nick":
-                if nm_to_n(prefix) == self.real_nickname:
-                    self.real_nickname = arguments[0]
-            elif command == "001":
-                # Record the nickname in case the client changed nick
-                # in a nicknameinuse callback.
-                self.real_nickname = arguments[0]
-
-            if command in ["privmsg", "notice"]:
-                target, message = arguments[0], arguments[1]
-                messages = _ctcp_dequote(message)
+            if line[0] == ":":
+                position = line.find(" ")
+                if position > 1:
+                    prefix = line[1:position]
+                    line = line[position:].lstrip(" ")
+                    if not self.real_server_name:
+                        self.real_server_name = prefix
+            position = line.find(" ")
+            if position < 0:
+                command = line.lower()
+                argument = ""
+            else:
+                command = line[:position].lower()
+                argument = line[position:]
 
+            if command == "privmsg" or command == "notice":
+                arguments = _split_arguments(argument)
+                target, message = arguments[0], arguments[1]
                 if command == "privmsg":
                     if is_channel(target):
                         command = "pubmsg"
@@ -549,7 +895,17 @@ class ServerConnection(Connection):
                     else:
                         command = "privnotice"
 
-                for m in messages:
+                if (_CTCP_DELIMITER not in message
+                    and _LOW_LEVEL_QUOTE not in message):
+                    if self._wants(command):
+                        if DEBUG:
+                            print "command: %s, source: %s, target: %s, arguments: %s" % (
+                                command, prefix, target, [message])
+                        self._handle_event(Event(command, prefix, target,
+                                                 [message]))
+                    continue
+
+                for m in _ctcp_dequote(message):
                     if type(m) is types.TupleType:
                         if command in ["privmsg", "pubmsg"]:
                             command = "ctcp"
@@ -566,29 +922,61 @@ class ServerConnection(Connection):
                             print "command: %s, source: %s, target: %s, arguments: %s" % (
                                 command, prefix, target, [m])
                         self._handle_event(Event(command, prefix, target, [m]))
-            else:
-                target = None
-
+            elif command == "quit" or command == "ping":
+                arguments = _split_arguments(argument)
                 if command == "quit":
-                    arguments = [arguments[0]]
-                elif command == "ping":
-                    target = arguments[0]
+                    target = None
+                    arguments = arguments[:1]
                 else:
                     target = arguments[0]
-                    arguments = arguments[1:]
-
-                if command == "mode":
+                if self._wants(command):
+                    if DEBUG:
+                        print "command: %s, source: %s, target: %s, arguments: %s" % (
+                            command, prefix, target, arguments)
+                    self._handle_event(Event(command, prefix, target,
+                                             arguments))
+            else:
+                # The target is the first argument, the others are only
+                # split if some handler asks for them.
+                argument = argument.lstrip(" ")
+                if argument[:1] == ":":
+                    target = argument[1:]
+                    argument = ""
+                else:
+                    position = argument.find(" ")
+                    if position < 0:
+                        target = argument
+                        argument = ""
+                    else:
+                        target = argument[:position]
+                        argument = argument[position:]
+
+                if command == "nick":
+                    if nm_to_n(prefix) == self.real_nickname:
+                        self.real_nickname = target
+                elif command == "001":
+                    # Record the nickname in case the client changed nick
+                    # in a nicknameinuse callback.
+                    self.real_nickname = target
+                elif command == "mode":
                     if not is_channel(target):
                         command = "umode"
 
                 # Translate numerics into more readable strings.
-                if numeric_events.has_key(command):
-                    command = numeric_events[command]
+                command = numeric_events.get(command, command)
+
+                if self._wants(command):
+                    event = Event(command, prefix, target, raw=argument)
+                    if DEBUG:
+                        print "command: %s, source: %s, target: %s, arguments: %s" % (
+                            command, prefix, target, event.arguments())
+                    self._handle_event(event)
 
-                if DEBUG:
-                    print "command: %s, source: %s, target: %s, arguments: %s" % (
-                        command, prefix, target, arguments)
-                self._handle_event(Event(command, prefix, target, arguments))
+    def _wants(self, eventtype):
+        """[Internal]"""
+        handlers = self.irclibobj.handlers
+        return (handlers.get("all_events") or handlers.get(eventtype)
+                or self.handlers.get(eventtype))
 
     def _handle_event(self, event):
         """[Internal]"""
@@ -646,6 +1034,7 @@ class ServerConnection(Connection):
             return
 
         self.connected = 0
+        self.irclibobj._unregister_socket(self.socket)
         try:
             self.socket.close()
         except socket.error, x:
@@ -881,6 +1270,7 @@ class DCCConnection(Connection):
         except socket.error, x:
             raise DCCConnectionError, "Couldn't connect to socket: %s" % x
         self.connected = 1
+        self.irclibobj._register_socket(self.socket, self)
         if self.irclibobj.fn_to_add_socket:
             self.irclibobj.fn_to_add_socket(self.socket)
         return self
@@ -905,6 +1295,7 @@ class DCCConnection(Connection):
             self.socket.listen(10)
         except socket.error, x:
             raise DCCConnectionError, "Couldn't bind socket: %s" % x
+        self.irclibobj._register_socket(self.socket, self)
         return self
 
     def disconnect(self, message=""):
@@ -918,6 +1309,7 @@ class DCCConnection(Connection):
             return
 
         self.connected = 0
+        self.irclibobj._unregister_socket(self.socket)
         try:
             self.socket.close()
         except socket.error, x:
@@ -933,9 +1325,11 @@ class DCCConnection(Connection):
 
         if self.passive and not self.connected:
             conn, (self.peeraddress, self.peerport) = self.socket.accept()
+            self.irclibobj._unregister_socket(self.socket)
             self.socket.close()
             self.socket = conn
             self.connected = 1
+            self.irclibobj._register_socket(self.socket, self)
             if DEBUG:
                 print "DCC connection from %s:%d" % (
                     self.peeraddress, self.peerport)
@@ -1015,7 +1409,8 @@ class SimpleIRCClient:
     (which is done when the server sends a JOIN messsage/command),
     on_privmsg will be called for "privmsg" events, and so on.  The
     handler methods get two arguments: the connection object (same as
-    self.connection) and the event object.
+    self.connection) and the event object.  Handler methods are looked
+    up when the client is created, so they may not be added later.
 
     Instance attributes that can be used by sub classes:
 
@@ -1029,7 +1424,12 @@ class SimpleIRCClient:
         self.ircobj = IRC()
         self.connection = self.ircobj.server()
         self.dcc_connections = []
-        self.ircobj.add_global_handler("all_events", self._dispatcher, -10)
+        # Only dispatch events having an on_ method, so the connection
+        # does not bother building the others.  This runs before the
+        # handlers of SingleServerIRCBot, as "all_events" handlers would.
+        for name in dir(self):
+            if name[:3] == "on_":
+                self.ircobj.add_global_handler(name[3:], self._dispatcher, -11)
         self.ircobj.add_global_handler("dcc_disconnect", self._dcc_disconnect, -10)
 
     def _dispatcher(self, c, e):
@@ -1100,9 +1500,11 @@ class SimpleIRCClient:
         self.ircobj.process_forever()
 
 
-class Event:
+class Event(object):
     """Class representing an IRC event."""
-    def __init__(self, eventtype, source, target, arguments=None):
+    __slots__ = "_eventtype", "_source", "_target", "_arguments", "_raw"
+
+    def __init__(self, eventtype, source, target, arguments=None, raw=None):
         """Constructor of Event objects.
 
         Arguments:
@@ -1114,12 +1516,19 @@ class Event:
             target -- The target of the event (a nick or a channel). XXX Correct?
 
             arguments -- Any event specific arguments.
+
+            raw -- Unsplit arguments, as received from the server.
+                   When given instead of arguments, they only get
+                   split when first asked for.
         """
         self._eventtype = eventtype
         self._source = source
         self._target = target
+        self._raw = raw
         if arguments:
             self._arguments = arguments
+        elif raw:
+            self._arguments = None
         else:
             self._arguments = []
 
@@ -1137,6 +1546,8 @@ class Event:
 
     def arguments(self):
         """Get the event arguments."""
+        if self._arguments is None:
+            self._arguments = _split_arguments(self._raw)
         return self._arguments
 
 _LOW_LEVEL_QUOTE = "\020"
@@ -1181,6 +1592,17 @@ def irc_lower(s):
     """
     return string.translate(s, _ircstring_translation)
 
+def _split_arguments(argument):
+    """[Internal] Split arguments of an IRC message.
+
+    The argument string starts with a space, unless empty.
+    """
+    a = argument.split(" :", 1)
+    arguments = a[0].split()
+    if len(a) == 2:
+        arguments.append(a[1])
+    return arguments
+
 def _ctcp_dequote(message):
     """[Internal] Dequote a message according to CTCP specifications.
 
@@ -1351,6 +1773,10 @@ def _parse_modes(mode_string, unary_modes=""):
             modes.append([sign, ch, None])
     return modes
 
+def _reraise(type, value, traceback):
+    """[Internal]"""
+    raise type, value, traceback
+
 def _ping_ponger(connection, event):
     """[Internal]"""
     connection.pong(event.target())
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Copyright © 2004 Progiciels Bourbeau-Pinard inc.
+# François Pinard <pinard@iro.umontreal.ca>, 2004.
+
+"""\
+Compare the former irclib line parser with the current one.
+
+Usage: parse.py [OPTION]... [FILE]
+
+FILE holds a capture of raw server lines, as received by a bot sitting
+on busy channels.  Without FILE, a similar capture gets synthesised.
+
+Options:
+  -n NUMBER    Number of lines to synthesise (default 100000).
+  -r NUMBER    Number of runs, keeping the best (default 3).
+"""
+
+__metaclass__ = type
+import random, re, string, sys, time, types
+from Cabot import irclib
+
+class Socket:
+    # Deliver a capture in chunks, the way the server socket would.
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def recv(self, size):
+        chunk = self.data[self.position:self.position + size]
+        self.position += size
+        return chunk
+
+    def send(self, data):
+        pass
+
+class Bot(irclib.SimpleIRCClient):
+    # Handlers of interest to Cabot and SingleServerIRCBot.
+    count = 0
+
+    def __init__(self, data, legacy):
+        irclib.SimpleIRCClient.__init__(self)
+        if legacy:
+            # Dispatch everything, as SimpleIRCClient used to.
+            for handlers in self.ircobj.handlers.values():
+                for handler in handlers[:]:
+                    if handler[1] == self._dispatcher:
+                        handlers.remove(handler)
+            self.ircobj.add_global_handler('all_events', self._dispatcher,
+                                           -10)
+        for event in ('disconnect', 'join', 'kick', 'mode', 'namreply',
+                      'nick', 'part', 'quit'):
+            self.connection.add_global_handler(event, self.on_event, -10)
+        connection = self.connection
+        connection.socket = Socket(data)
+        connection.previous_buffer = ''
+        connection.handlers = {}
+        connection.real_server_name = ''
+        connection.real_nickname = 'cabot'
+        connection.connected = 1
+
+    def on_event(self, connection, event):
+        self.count += 1
+        event.arguments()
+
+    on_privmsg = on_pubmsg = on_ctcp = on_welcome = on_event
+
+class Main:
+    number_lines = 100000
+    number_runs = 3
+
+    def main(self, *arguments):
+        import getopt
+        options, arguments = getopt.getopt(arguments, 'n:r:')
+        for option, value in options:
+            if option == '-n':
+                self.number_lines = int(value)
+            elif option == '-r':
+                self.number_runs = int(value)
+        if arguments:
+            lines = file(arguments[0]).read().splitlines()
+        else:
+            lines = capture(self.number_lines)
+        data = '\r\n'.join(lines) + '\r\n'
+        for name, function in (('former', former_process_data),
+                               ('current', irclib.ServerConnection.process_data)):
+            best = None
+            for counter in range(self.number_runs):
+                bot = Bot(data, function is former_process_data)
+                start = time.time()
+                while bot.connection.socket.position < len(data):
+                    function(bot.connection)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            sys.stdout.write("%-8s %10.0f lines/sec, %d events handled.\n"
+                             % (name, len(lines) / best, bot.count))
+
+run = Main()
+main = run.main
+
+def capture(count):
+    random.seed(0)
+    nicks = ['nick%d' % counter for counter in range(200)]
+    channels = '#python', '#debian', '#cabot'
+    words = ('the', 'a', 'bot', 'is', 'pun', 'why', 'does', 'it', 'work',
+             'here', 'on', 'my', 'machine', 'lol', 'ok', 'thanks')
+    lines = []
+    for counter in range(count):
+        nick = random.choice(nicks)
+        prefix = ':%s!~%s@host%d.example.org ' % (nick, nick, hash(nick) % 97)
+        channel = random.choice(channels)
+        text = ' '.join([random.choice(words)
+                         for counter in range(random.randrange(1, 15))])
+        draw = random.random()
+        if draw < .80:
+            lines.append(prefix + 'PRIVMSG %s :%s' % (channel, text))
+        elif draw < .85:
+            lines.append(prefix + 'JOIN :%s' % channel)
+        elif draw < .89:
+            lines.append(prefix + 'PART %s :%s' % (channel, text))
+        elif draw < .92:
+            lines.append(prefix + 'QUIT :Quit: %s' % text)
+        elif draw < .94:
+            lines.append(prefix + 'NICK :%s_' % nick)
+        elif draw < .96:
+            lines.append(prefix + 'MODE %s +v %s' % (channel,
+                                                     random.choice(nicks)))
+        elif draw < .97:
+            lines.append(prefix + 'NOTICE %s :%s' % (channel, text))
+        elif draw < .98:
+            lines.append(prefix + 'PRIVMSG %s :\001ACTION %s\001'
+                         % (channel, text))
+        elif draw < .99:
+            lines.append('PING :irc.example.org')
+        else:
+            lines.append(':irc.example.org 353 cabot = %s :%s'
+                         % (channel, ' '.join(random.sample(nicks, 20))))
+    return lines
+
+## Former parser, as it was in irclib.
+
+class Event:
+
+    def __init__(self, eventtype, source, target, arguments=None):
+        self._eventtype = eventtype
+        self._source = source
+        self._target = target
+        if arguments:
+            self._arguments = arguments
+        else:
+            self._arguments = []
+
+    def eventtype(self):
+        return self._eventtype
+
+    def source(self):
+        return self._source
+
+    def target(self):
+        return self._target
+
+    def arguments(self):
+        return self._arguments
+
+_rfc_1459_command_regexp = re.compile("^(:(?P<prefix>[^ ]+) +)?(?P<command>[^ ]+)( *(?P<argument> .+))?")
+
+def former_process_data(self):
+    new_data = self.socket.recv(2**14)
+    lines = irclib._linesep_regexp.split(self.previous_buffer + new_data)
+    self.previous_buffer = lines[-1]
+    lines = lines[:-1]
+
+    for line in lines:
+        if not line:
+            continue
+
+        prefix = None
+        command = None
+        arguments = None
+        self._handle_event(Event("all_raw_messages",
+                                 self.get_server_name(),
+                                 None,
+                                 [line]))
+
+        m = _rfc_1459_command_regexp.match(line)
+        if m.group("prefix"):
+            prefix = m.group("prefix")
+            if not self.real_server_name:
+                self.real_server_name = prefix
+
+        if m.group("command"):
+            command = string.lower(m.group("command"))
+
+        if m.group("argument"):
+            a = string.split(m.group("argument"), " :", 1)
+            arguments = string.split(a[0])
+            if len(a) == 2:
+                arguments.append(a[1])
+
+        if command == "nick":
+            if irclib.nm_to_n(prefix) == self.real_nickname:
+                self.real_nickname = arguments[0]
+        elif command == "001":
+            self.real_nickname = arguments[0]
+
+        if command in ["privmsg", "notice"]:
+            target, message = arguments[0], arguments[1]
+            messages = irclib._ctcp_dequote(message)
+
+            if command == "privmsg":
+                if irclib.is_channel(target):
+                    command = "pubmsg"
+            else:
+                if irclib.is_channel(target):
+                    command = "pubnotice"
+                else:
+                    command = "privnotice"
+
+            for m in messages:
+                if type(m) is types.TupleType:
+                    if command in ["privmsg", "pubmsg"]:
+                        command = "ctcp"
+                    else:
+                        command = "ctcpreply"
+                    m = list(m)
+                    self._handle_event(Event(command, prefix, target, m))
+                else:
+                    self._handle_event(Event(command, prefix, target, [m]))
+        else:
+            target = None
+
+            if command == "quit":
+                arguments = [arguments[0]]
+            elif command == "ping":
+                target = arguments[0]
+            else:
+                target = arguments[0]
+                arguments = arguments[1:]
+
+            if command == "mode":
+                if not irclib.is_channel(target):
+                    command = "umode"
+
+            if irclib.numeric_events.has_key(command):
+                command = irclib.numeric_events[command]
+
+            self._handle_event(Event(command, prefix, target, arguments))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
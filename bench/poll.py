@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Copyright © 2004 Progiciels Bourbeau-Pinard inc.
+# François Pinard <pinard@iro.umontreal.ca>, 2004.
+
+"""\
+Compare per-tick socket scanning with the irclib poller registry.
+
+Usage: poll.py [OPTION]...
+
+Options:
+  -n NUMBER    Number of idle connections (default 500).
+  -t NUMBER    Number of ticks, each with one busy connection (default 2000).
+"""
+
+__metaclass__ = type
+import random, select, socket, sys, time
+from Cabot import irclib
+
+class Connection:
+
+    def __init__(self):
+        self.socket, self.peer = socket.socketpair()
+
+    def _get_socket(self):
+        return self.socket
+
+    def process_data(self):
+        self.socket.recv(100)
+
+class Main:
+    number_connections = 500
+    number_ticks = 2000
+
+    def main(self, *arguments):
+        import getopt
+        options, arguments = getopt.getopt(arguments, 'n:t:')
+        for option, value in options:
+            if option == '-n':
+                self.number_connections = int(value)
+            elif option == '-t':
+                self.number_ticks = int(value)
+        random.seed(0)
+        connections = [Connection()
+                       for counter in range(self.number_connections)]
+        busy = [random.choice(connections)
+                for counter in range(self.number_ticks)]
+
+        def scan():
+            # What IRC.process_once and IRC.process_data used to do.
+            for connection in busy:
+                connection.peer.send('x')
+                sockets = map(lambda x: x._get_socket(), connections)
+                sockets = filter(lambda x: x != None, sockets)
+                (i, o, e) = select.select(sockets, [], [], 0)
+                for s in i:
+                    for c in connections:
+                        if s == c._get_socket():
+                            c.process_data()
+
+        def registry(backend):
+            poller = irclib.Poller(backend)
+            for connection in connections:
+                poller.register(connection.socket.fileno(), connection)
+
+            def run():
+                for connection in busy:
+                    connection.peer.send('x')
+                    for c in poller.poll(0):
+                        c.process_data()
+
+            return run
+
+        tests = [('scan', scan)]
+        for backend in 'epoll', 'poll', 'select':
+            if hasattr(select, backend):
+                tests.append((backend, registry(backend)))
+        for name, function in tests:
+            start = time.time()
+            function()
+            elapsed = time.time() - start
+            sys.stdout.write("%-8s %8.1f us per tick, %d connections.\n"
+                             % (name, 1e6 * elapsed / len(busy),
+                                len(connections)))
+
+run = Main()
+main = run.main
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
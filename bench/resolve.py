@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Copyright © 2004 Progiciels Bourbeau-Pinard inc.
+# François Pinard <pinard@iro.umontreal.ca>, 2004.
+
+"""\
+Compare substring resolution by linear scan and through trigrams.
+
+Usage: resolve.py [OPTION]...
+
+Options:
+  -n NUMBER    Number of synthetic canonical words (default 1000000).
+  -q NUMBER    Number of patterns to resolve (default 1000).
+"""
+
+__metaclass__ = type
+import random, sys, time
+from Cabot import database
+
+class Main:
+    number_words = 1000000
+    number_queries = 1000
+
+    def main(self, *arguments):
+        import getopt
+        options, arguments = getopt.getopt(arguments, 'n:q:')
+        for option, value in options:
+            if option == '-n':
+                self.number_words = int(value)
+            elif option == '-q':
+                self.number_queries = int(value)
+        random.seed(0)
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        words = set()
+        while len(words) < self.number_words:
+            words.add(''.join([random.choice(letters)
+                               for counter in range(random.randint(3, 12))]))
+        words = list(words)
+        start = time.time()
+        trigrams = database.Trigram_index(words)
+        sys.stdout.write("%d words indexed in %.2f s.\n"
+                         % (len(words), time.time() - start))
+        # Half the patterns are typos of known words, half are substrings.
+        patterns = []
+        for counter in range(self.number_queries):
+            word = random.choice(words)
+            if counter % 2:
+                start = random.randrange(len(word) - 2)
+                patterns.append(word[start:start+random.randint(3, 5)])
+            else:
+                patterns.append(word[:-1] + random.choice(letters))
+
+        def scan(pattern):
+            return [word for word in words if pattern in word]
+
+        def lookup(pattern):
+            return [word for word in trigrams.candidates(pattern)
+                    if pattern in word]
+
+        for name, function in ('scan', scan), ('trigrams', lookup):
+            start = time.time()
+            found = 0
+            for pattern in patterns:
+                found += len(function(pattern))
+            elapsed = time.time() - start
+            sys.stdout.write("%-8s %10.3f ms per pattern, %d words found.\n"
+                             % (name, 1000 * elapsed / len(patterns), found))
+
+run = Main()
+main = run.main
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
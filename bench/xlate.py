@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Copyright © 2004 Progiciels Bourbeau-Pinard inc.
+# François Pinard <pinard@iro.umontreal.ca>, 2004.
+
+"""\
+Compare interpreted and compiled letter-to-sound translation.
+
+Usage: xlate.py [OPTION]... [FILE]
+
+Options:
+  -q NUMBER    Number of chat-like words for the memo test (default 200000).
+
+FILE is a list of English words and defaults to `/usr/share/dict/words', or
+else to the words of `database/phones'.  Every word is translated both ways
+and any difference in phonemes is reported.
+"""
+
+__metaclass__ = type
+import os, random, sys, time
+from Cabot import autopun
+
+class Main:
+    number_queries = 200000
+
+    def main(self, *arguments):
+        import getopt
+        options, arguments = getopt.getopt(arguments, 'q:')
+        for option, value in options:
+            if option == '-q':
+                self.number_queries = int(value)
+        assert len(arguments) <= 1, arguments
+        if arguments:
+            words = [line.split()[0] for line in file(arguments[0])]
+        elif os.path.exists('/usr/share/dict/words'):
+            words = [line.split()[0] for line in file('/usr/share/dict/words')
+                     if line.strip()]
+        else:
+            name = os.path.join(os.path.dirname(sys.argv[0]), '..',
+                                'database', 'phones')
+            words = [line.split()[0] for line in file(name)]
+        results = {}
+        for name, function in (('interpreted', autopun.interpret_word),
+                               ('compiled', autopun.translate_word)):
+            start = time.time()
+            results[name] = map(function, words)
+            elapsed = time.time() - start
+            sys.stdout.write("%-12s %8.2f us per word, %d words.\n"
+                             % (name, 1e6 * elapsed / len(words), len(words)))
+        differences = 0
+        for word, before, after in zip(words, results['interpreted'],
+                                       results['compiled']):
+            if before != after:
+                differences += 1
+                sys.stdout.write("Differ: %s %r %r\n" % (word, before, after))
+        sys.stdout.write("%d differences.\n" % differences)
+        # Chat vocabulary is skewed, draw words along a Zipf-like law.
+        random.seed(0)
+        queries = [words[int(len(words) ** random.random()) - 1]
+                   for counter in range(self.number_queries)]
+        start = time.time()
+        for word in queries:
+            autopun.xlate_word(word)
+        elapsed = time.time() - start
+        sys.stdout.write("%-12s %8.2f us per word, %s.\n"
+                         % ('memoized', 1e6 * elapsed / len(queries),
+                            autopun.translations.report()))
+
+run = Main()
+main = run.main
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])